@@ -25,8 +25,8 @@ import pandas as pd
 import argparse
 import os
 from collections import defaultdict
-import gtfparse
 import logging
+import gencode_cache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -43,27 +43,22 @@ def GenMap(gtf_file, results):
     ensps = defaultdict(set)  # gene_name -> <set(ENSPs)>
     isonames = defaultdict(set)  # transcript name -> gene_name
 
-    # Parse GTF file
-    with open(gtf_file, 'r') as file:
-        for line in file:
-            if line.startswith('#'):
+    # Load transcript records from the compiled GTF
+    columns = ['gene_id', 'gene_name', 'transcript_id', 'transcript_name', 'transcript_type', 'protein_id']
+    transcripts = gencode_cache.load_gtf(gtf_file, results.reference_cache, features=['transcript'])
+    transcripts = transcripts.reindex(columns=columns, fill_value='')
+    for ensg, gene, enst, transcript_name, transcript_type, ensp in transcripts.itertuples(index=False):
+        if not (ensg and gene and enst and transcript_name):
+            logging.warning(f"Unexpected format in transcript: {enst}")
+            continue
+        genes[ensg] = gene
+        isos[enst] = transcript_name
+        isonames[gene].add(transcript_name)
+        if transcript_type.startswith('protein_coding'):
+            if not ensp:
+                logging.warning(f"Unexpected format in transcript: {enst}")
                 continue
-            wds = line.split('\t')
-            cat = wds[2]
-            if cat == 'transcript':
-                try:
-                    ensg = line.split('gene_id "')[1].split('"')[0]
-                    gene = line.split('gene_name "')[1].split('"')[0]
-                    enst = line.split('transcript_id "')[1].split('"')[0]
-                    transcript_name = line.split('transcript_name "')[1].split('"')[0]
-                    genes[ensg] = gene
-                    isos[enst] = transcript_name
-                    isonames[gene].add(transcript_name)
-                    if 'transcript_type "protein_coding' in line:
-                        ensp = line.split('protein_id "')[1].split('"')[0]
-                        ensps[gene].add(ensp)
-                except IndexError:
-                    logging.warning(f"Unexpected format in line: {line}")
+            ensps[gene].add(ensp)
 
     # Save Tables in results/PG_ReferenceTables 
     with open(results.ensg_gene, 'w') as ofile:
@@ -132,8 +127,8 @@ def protein_coding_genes(results):
     """
     Extract and save the list of protein-coding genes from the GTF file
     """
-    # Read the GTF file using gtfparse
-    df_gtf = gtfparse.read_gtf(results.gtf_file)
+    # Load the compiled GTF
+    df_gtf = gencode_cache.load_gtf(results.gtf_file, results.reference_cache)
 
     # Print DataFrame columns and the first few rows
     logging.info("DataFrame Columns:")
@@ -165,6 +160,7 @@ def main():
     parser.add_argument('--isoname_lens', '-oigl', action='store', dest='isoname_lens', help='Isoname length table output location', required=True)
     parser.add_argument('--gene_lens', '-ogls', action='store', dest='gene_lens', help='Gene Length statistics output location', required=True)
     parser.add_argument('--protein_coding_genes', '-pcg', action='store', dest='pc_genes', help='Protein Coding genes output location', required=True)
+    parser.add_argument('--reference_cache', '-rc', action='store', dest='reference_cache', help='Compiled GENCODE reference directory', default=gencode_cache.DEFAULT_CACHE_DIR)
     results = parser.parse_args()
 
     # Ensure input files exist
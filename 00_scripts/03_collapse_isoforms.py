@@ -4,8 +4,9 @@ from cupcake.io import GFF
 from collections import defaultdict
 from cupcake.tofu import compare_junctions
 import os
+import re
 import argparse
-from Bio import SeqIO
+from fasta_partition import partition_fasta
 
 ### helper functions
 
@@ -85,13 +86,8 @@ def collapse_isoforms(gff_filename, fasta_filename, output_dir, name):
                 good_ids.add(record.seqid)
 
     # Write filtered FASTA (only keeping good_ids)
-    with open(output_fasta_path, 'w') as out_fasta, \
-         open(os.path.join(dropout_dir, f"{name}_dropout.fasta"), 'w') as dropout_fasta:
-        for record in SeqIO.parse(fasta_filename, 'fasta'):
-            if record.id in good_ids:
-                SeqIO.write(record, out_fasta, 'fasta')
-            else:
-                SeqIO.write(record, dropout_fasta, 'fasta')
+    partition_fasta(fasta_filename, [(output_fasta_path, good_ids)],
+                    default=os.path.join(dropout_dir, f"{name}_dropout.fasta"))
 
     # Write dropout GTF
     with open(gff_filename, 'r') as gtf_in, \
@@ -8,16 +8,10 @@ import shutil
 import re 
 import logging
 import gtfparse
-from Bio import SeqIO
+from fasta_partition import partition_fasta
 
 logging.basicConfig(filename='sqanti_filter.log', encoding='utf-8', level=logging.DEBUG)
 
-def write_dropout_fasta(dropout_ids, input_fasta_path, output_fasta_path):
-    with open(output_fasta_path, "w") as out_f:
-        for record in SeqIO.parse(input_fasta_path, "fasta"):
-            if record.id in dropout_ids:
-                SeqIO.write(record, out_f, "fasta")
-
 def write_dropout_gtf(dropout_ids, input_gtf_path, output_gtf_path):
     with open(input_gtf_path, "r") as in_gtf, open(output_gtf_path, "w") as out_gtf:
         for line in in_gtf:
@@ -94,13 +88,10 @@ def save_filtered_sqanti_gtf(gtf_file, filtered_isoforms, output_path):
             if transcript in filtered_isoforms:
                 ofile.write(line)
 
-def save_filtered_sqanti_fasta(fasta_file, filtered_isoforms, output_path):
-    logging.info("Saving FASTA")
-    filtered_sequences = []
-    for record in SeqIO.parse(fasta_file, "fasta"):
-        if record.id in filtered_isoforms:
-            filtered_sequences.append(record)
-    SeqIO.write(filtered_sequences, output_path, "fasta")
+def split_filtered_and_dropout_fasta(fasta_file, filtered_isoforms, output_path, dropout_ids, dropout_path):
+    logging.info("Saving filtered and dropout FASTA")
+    # filtered and dropout records are split in one pass over the corrected FASTA
+    partition_fasta(fasta_file, [(output_path, filtered_isoforms), (dropout_path, dropout_ids)])
 
 
 def main():
@@ -179,13 +170,12 @@ def main():
     # Save filtered files
     sqanti_df.to_csv(os.path.join(args.output_dir, f"filtered_{base_class_name}"), sep="\t", index=False)
     save_filtered_sqanti_gtf(args.corrected_gtf, kept_ids, os.path.join(args.output_dir, f"filtered_{base_gtf_name}"))
-    save_filtered_sqanti_fasta(args.corrected_fasta, kept_ids, os.path.join(args.output_dir, f"filtered_{base_fasta_name}"))
+    split_filtered_and_dropout_fasta(args.corrected_fasta, kept_ids, os.path.join(args.output_dir, f"filtered_{base_fasta_name}"),
+                                     dropout_ids, os.path.join(dropout_dir, f"dropout_{base_fasta_name}"))
 
     # Save dropout files
     write_dropout_classification(dropout_ids, args.classification_file,
                                   os.path.join(dropout_dir, f"dropout_{base_class_name}"))
-    write_dropout_fasta(dropout_ids, args.corrected_fasta,
-                        os.path.join(dropout_dir, f"dropout_{base_fasta_name}"))
     write_dropout_gtf(dropout_ids, args.corrected_gtf,
                       os.path.join(dropout_dir, f"dropout_{base_gtf_name}"))
 
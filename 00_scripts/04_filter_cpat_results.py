@@ -3,8 +3,8 @@
 
 import argparse
 import pandas as pd
-from Bio import SeqIO
 import os
+from fasta_partition import partition_fasta
 
 def main():
     parser = argparse.ArgumentParser(description="Filter CPAT output and generate filtered/dropout FASTA and TSV files.")
@@ -28,15 +28,10 @@ def main():
     coding_df.to_csv(os.path.join(args.output_dir, f"{args.prefix}_cpat.tsv"), sep="\t", index=False)
     dropout_df.to_csv(os.path.join(args.output_dir, f"dropout_{args.prefix}_cpat.tsv"), sep="\t", index=False)
 
-    with open(os.path.join(args.output_dir, f"{args.prefix}_cpat.fasta"), "w") as coding_out:
-        for record in SeqIO.parse(args.input_fasta, "fasta"):
-            if record.id in coding_ids:
-                SeqIO.write(record, coding_out, "fasta")
-
-    with open(os.path.join(args.output_dir, f"dropout_{args.prefix}_cpat.fasta"), "w") as dropout_out:
-        for record in SeqIO.parse(args.input_fasta, "fasta"):
-            if record.id in dropout_ids:
-                SeqIO.write(record, dropout_out, "fasta")
+    partition_fasta(args.input_fasta, [
+        (os.path.join(args.output_dir, f"{args.prefix}_cpat.fasta"), coding_ids),
+        (os.path.join(args.output_dir, f"dropout_{args.prefix}_cpat.fasta"), dropout_ids),
+    ])
 
     print(f"CPAT filtering complete. {len(coding_ids)} coding, {len(dropout_ids)} dropped.")
 
@@ -33,8 +33,9 @@ apptainer exec /project/sheynkman/dockers/LRP/orf_calling_latest.sif /bin/bash -
     --pb_gene 04_transcriptome_summary/pb_gene.tsv \
     --classification 03_filter_sqanti/sample_classification.5degfilter.tsv \
     --sample_fasta 03_filter_sqanti/sample_corrected.5degfilter.fasta \
-    --output_mutant 05_orf_calling/best_ORF_condition1.tsv \
-    --output_wt 05_orf_calling/best_ORF_condition2.tsv
+    --condition condition1=BioSample_1,BioSample_2,BioSample_3 \
+    --condition condition2=BioSample_4,BioSample_5,BioSample_6 \
+    --output_dir 05_orf_calling
 "
 
 conda deactivate
@@ -1,42 +1,123 @@
 from gtfparse import read_gtf
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 from collections import defaultdict
 import argparse
+import os
 from Bio import SeqIO
 import pandas as pd
 import numpy as np
 import logging
-import itertools
-
-def is_orf_called_with_stop_codon(orf_fasta, stop_codons=('TAG','TAA','TGA')):  
+import re
+from array import array
+import gencode_cache
+
+ORF_ID_PATTERN = re.compile(r'^(?P<pb_acc>[^_|]*)[^_]*_[^_]*_(?P<orf_rank>\d+)$')
+ATG_PATTERN = re.compile('ATG')
+ORF_COLUMNS = ['ID','len', 'orf_strand', 'orf_frame', 'orf_start', 'orf_end', 'orf_len', 'fickett', 'hexamer', 'coding_score']
+ORF_DTYPES = {'len': np.int32, 'orf_strand': pd.CategoricalDtype(['+', '-']), 'orf_frame': np.int8,
+              'orf_start': np.int32, 'orf_end': np.int32, 'orf_len': np.int32,
+              'fickett': np.float64, 'hexamer': np.float64, 'coding_score': np.float64}
+
+def hash_ids(ids):
+    """Hashes ORF IDs to uint64 so large ID sets can be held and searched as NumPy arrays"""
+    return pd.util.hash_array(np.asarray(ids, dtype=object))
+
+def is_orf_called_with_stop_codon(orf_fasta, stop_codons=('TAG','TAA','TGA'), batch_size=1000000):  
     """Determines if orf was called with a stop codon as determined by CPAT
     stop codon is True if last codon is in tuple of stop_codons used.
 
+    The fasta is streamed and only the tail of each sequence is kept, so memory is
+    one hashed ID and one flag per ORF regardless of the fasta size.
+
     Args:
         orf_fasta (str): filename of orf fasta file
         stop_codons (tuple, optional): stop codons to use in check. Defaults to ('TAG','TAA','TGA').
+        batch_size (int, optional): number of records hashed at a time
 
     Returns:
-        pandas DataFrame: columns:[ID (str), has_stop_codon (bool)]
+        tuple: (sorted uint64 ID hashes, bool has_stop_codon aligned to the hashes)
     """
-    orf_stop_codon_status_list = []
-    for record in SeqIO.parse(orf_fasta, 'fasta'):
-        orf_stop_codon_status_list.append([record.id,str(record.seq).endswith(stop_codons)])
-    orf_stop_codon_status = pd.DataFrame(orf_stop_codon_status_list, columns=['ID','has_stop_codon'])
-    return orf_stop_codon_status
-
-def orf_mapping(orf_coord, gencode, sample_gtf, orf_seq, pool, num_cores = 12):
-    def get_num_upstream_atgs(row):
-        orf_start = int(row['orf_start'])
-        acc = row['pb_acc']
-        if acc in orf_seq.keys():
-            seq = orf_seq[acc] 
-        else:
-            return np.inf
-        upstream_seq = seq[0:orf_start-1] # sequence up to the predicted ATG
-        num_atgs = upstream_seq.count('ATG')
-        return num_atgs
+    hashes, statuses = [], []
+    ids, status = [], []
+    def flush():
+        if ids:
+            hashes.append(hash_ids(ids))
+            statuses.append(np.array(status, dtype=bool))
+            del ids[:], status[:]
+
+    record_id, tail = None, ''
+    with open(orf_fasta) as handle:
+        for line in handle:
+            if line.startswith('>'):
+                if record_id is not None:
+                    ids.append(record_id)
+                    status.append(tail.endswith(stop_codons))
+                    if len(ids) >= batch_size:
+                        flush()
+                record_id, tail = line[1:].split(None, 1)[0], ''
+            else:
+                tail = (tail + line.strip())[-3:]
+    if record_id is not None:
+        ids.append(record_id)
+        status.append(tail.endswith(stop_codons))
+    flush()
+
+    if not hashes:
+        return np.array([], dtype=np.uint64), np.array([], dtype=bool)
+    hashes, statuses = np.concatenate(hashes), np.concatenate(statuses)
+    order = np.argsort(hashes, kind='mergesort')
+    return hashes[order], statuses[order]
+
+def atg_position_index(sample_fasta):
+    """Builds sorted ATG start positions for every transcript in the sample fasta, once.
+
+    Positions are stored CSR-style: transcript i owns positions[offsets[i]:offsets[i+1]].
+    genome_positions adds a per-transcript base offset so the whole array is increasing and
+    can be searched with a single searchsorted.
+
+    Args:
+        sample_fasta (str): filename of the sample transcript fasta
 
+    Returns:
+        dict: acc_row (accession -> transcript index), lengths, offsets, positions, genome_positions
+    """
+    acc_row, lengths = {}, []
+    offsets, positions = array('q', [0]), array('q')
+    for record in SeqIO.parse(sample_fasta, 'fasta'):
+        seq = str(record.seq)
+        acc_row[record.id.split('|')[0]] = len(lengths)
+        lengths.append(len(seq))
+        positions.extend(match.start() for match in ATG_PATTERN.finditer(seq))
+        offsets.append(len(positions))
+    lengths = np.array(lengths, dtype=np.int64)
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    positions = np.frombuffer(positions, dtype=np.int64)
+    base = np.concatenate([[0], np.cumsum(lengths + 1)[:-1]]) if len(lengths) else lengths
+    genome_positions = positions + np.repeat(base, np.diff(offsets))
+    return {'acc_row': acc_row, 'lengths': lengths, 'base': base, 'offsets': offsets,
+            'positions': positions, 'genome_positions': genome_positions}
+
+def count_upstream_atgs(orfs, atg_index):
+    """Counts ATGs fully upstream of each ORF start (seq[0:orf_start-1]) in one vectorized pass.
+    ORFs whose accession is not in the sample fasta get np.inf.
+    """
+    row = orfs['pb_acc'].map(atg_index['acc_row'])
+    found = row.notna().to_numpy()
+    row = row[found].to_numpy(dtype=np.int64)
+    length = atg_index['lengths'][row]
+    # same bounds as slicing seq[0:orf_start-1]
+    upstream_end = orfs['orf_start'].to_numpy(dtype=np.int64)[found] - 1
+    upstream_end = np.where(upstream_end < 0, np.maximum(upstream_end + length, 0), np.minimum(upstream_end, length))
+    last_start = atg_index['base'][row] + upstream_end - 3
+    num_atgs = np.searchsorted(atg_index['genome_positions'], last_start, side='right') - atg_index['offsets'][row]
+    if found.all():
+        return pd.Series(num_atgs, index=orfs.index)
+    upstream_atgs = np.full(len(orfs), np.inf)
+    upstream_atgs[found] = num_atgs
+    return pd.Series(upstream_atgs, index=orfs.index)
+
+def orf_mapping(orf_coord, gencode, sample_gtf, atg_index, pool, num_cores = 12):
     print(sample_gtf.head())
 
     exons = sample_gtf[sample_gtf['feature'] == 'exon'].copy()
@@ -51,136 +132,211 @@ def orf_mapping(orf_coord, gencode, sample_gtf, orf_seq, pool, num_cores = 12):
     start_codons = gencode[gencode['feature'] == 'start_codon']
     start_codons = start_codons[['seqname','transcript_id','strand',  'start', 'end']].copy()
     start_codons.rename(columns = {'start' : 'start_codon_start', 'end': 'start_codon_end'}, inplace = True)
-        
-    logging.info("Mapping plus strands...")
-    plus = plus_mapping(exons, orf_coord, start_codons, pool, num_cores)
-    logging.info("Mapping minus strands...")
-    minus = minus_mapping(exons, orf_coord, start_codons, pool, num_cores)
-    all_cds = pd.concat([plus, minus])
+
+    logging.info("Mapping plus and minus strands...")
+    all_cds = map_orf_starts(exons, orf_coord, pool, num_cores)
+    all_cds['gencode_atg'] = compare_start(all_cds, start_codons)
     
-    all_cds['upstream_atgs'] = all_cds.apply(get_num_upstream_atgs, axis=1)
+    all_cds['upstream_atgs'] = count_upstream_atgs(all_cds, atg_index)
     return all_cds
 
-def compare_start_plus(row, start_codons):
-    start = int(row['cds_start'])
-    match = start_codons[start_codons['start_codon_start'] == start]
-    if len(match) > 0:
-        return list(match['transcript_id'])
-    return None
-
-def plus_mapping_single_chromosome(orf_coord, plus_exons, start_codons):
-    plus_exons['current_size'] = plus_exons.sort_values(by = ['transcript_id', 'exon_start']).groupby('transcript_id')['exon_length'].cumsum()
-    plus_exons['prior_size'] = plus_exons['current_size'] - plus_exons['exon_length']
-    orf_exons = pd.merge(orf_coord, plus_exons, left_on = 'pb_acc', right_on = 'transcript_id', how = 'inner')
-    orf_exons = orf_exons[(orf_exons['prior_size'] <= orf_exons['orf_start']) &  (orf_exons['orf_start'] <= orf_exons['current_size'])]
-    if len(orf_exons) ==0 :
-        logging.warning("no coding start found")
-        return orf_exons
-    orf_exons['start_diff'] = orf_exons['orf_start'] - orf_exons['prior_size']
-    orf_exons['cds_start'] = orf_exons['exon_start'] + orf_exons['start_diff'] - 1
-    orf_exons['gencode_atg'] = orf_exons.apply(lambda row : compare_start_plus(row, start_codons), axis = 1)
-    orf_exons.drop(columns=['exon_length', 'current_size', 'prior_size', 'start_diff'], inplace = True)
-    return orf_exons
+def start_codon_index(start_codons):
+    """Builds a lookup of GENCODE start codon position to matching transcripts.
 
-def plus_mapping(exons, orf_coord, start_codons, pool, num_cores = 12):
+    Plus strand ORFs are compared to the start codon start and minus strand ORFs to its end.
 
-    plus_exons = exons[exons['strand'] == '+'].copy()
-    start_codons = start_codons[start_codons['strand'] == '+']
-    
-    orf_chromosomes = plus_exons['seqname'].unique()
-    ref_chromosomes = start_codons['seqname'].unique()
-    
-    accession_map = plus_exons.groupby('seqname')['transcript_id'].apply(list).to_dict()
-    orf_coord_list = [orf_coord[orf_coord['pb_acc'].isin(accession_map[csome])].copy() for csome in orf_chromosomes]
-    exon_list = [plus_exons[plus_exons['seqname'] == csome].copy() for csome in orf_chromosomes]
-    
-    start_codon_list = []
-    for csome in orf_chromosomes:
-        if csome in ref_chromosomes:
-            start_codon_list.append(start_codons[start_codons['seqname'] == csome].copy())
-        else:
-            start_codon_list.append(start_codons.head())
-                                                 
-    # pool = multiprocessing.Pool(processes = num_cores)
-    iterable = zip(orf_coord_list, exon_list, start_codon_list)
-    plus_orf_list = pool.starmap(plus_mapping_single_chromosome, iterable)
-
-    if len(plus_orf_list) > 0:
-        plus_orfs = pd.concat(plus_orf_list)
-    else:
-        plus_orfs = pd.DataFrame(columns = orf_coord.columns)
-    
-    return plus_orfs
-    
-def compare_start_minus(row, start_codons):
-    start = int(row['cds_start'])
-    match = start_codons[(start_codons['start_codon_end'] == start) ]
-    if len(match) > 0:
-        return list(match['transcript_id'])
-    return None
-
-def minus_mapping_single_chromosome(orf_coord, minus_exons, start_codons):
-    
-    minus_exons['current_size'] = minus_exons.sort_values(by = ['transcript_id', 'exon_start'], ascending=[True,False]).groupby('transcript_id')['exon_length'].cumsum()
-    minus_exons['prior_size'] = minus_exons['current_size'] - minus_exons['exon_length']
-    orf_exons = pd.merge(orf_coord, minus_exons, left_on = 'pb_acc', right_on = 'transcript_id', how = 'inner')
-    orf_exons = orf_exons[orf_exons['orf_start'].between(orf_exons['prior_size'],orf_exons['current_size'])]
-    if len(orf_exons) == 0:
-        logging.warning("No orf start codons found...")
-        return orf_exons
-    orf_exons['start_diff'] = orf_exons['orf_start'] - orf_exons['prior_size']
-    orf_exons['cds_start'] = orf_exons['exon_end'] - orf_exons['start_diff'] + 1
-    orf_exons['gencode_atg'] = orf_exons.apply(lambda row : compare_start_minus(row, start_codons), axis = 1)
-    orf_exons.drop(columns=['exon_length', 'current_size', 'prior_size', 'start_diff'], inplace = True)
+    Args:
+        start_codons (pandas DataFrame): start codons with start_codon_start/start_codon_end columns
+
+    Returns:
+        pandas Series: (strand, seqname, position) -> list of transcript_id, in start_codons order
+    """
+    start_codons = start_codons.assign(position = np.where(start_codons['strand'] == '+',
+                                                           start_codons['start_codon_start'],
+                                                           start_codons['start_codon_end']))
+    return start_codons.groupby(['strand', 'seqname', 'position'], sort=False)['transcript_id'].apply(list)
+
+def compare_start(orf_exons, start_codons):
+    atg_index = start_codon_index(start_codons).rename('gencode_atg')
+    keys = orf_exons[['strand', 'seqname', 'cds_start']].astype({'strand': object, 'seqname': object, 'cds_start': np.int64})
+    return keys.join(atg_index, on=['strand', 'seqname', 'cds_start'])['gencode_atg']
+
+def share_arrays(arrays):
+    """Copies NumPy arrays into shared memory blocks so pool workers can read them without pickling.
+
+    Args:
+        arrays (dict): name -> numpy array
+
+    Returns:
+        tuple: (list of SharedMemory blocks owned by the caller, dict name -> (block name, shape, dtype))
+    """
+    blocks, specs = [], {}
+    for name, values in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        specs[name] = (block.name, values.shape, values.dtype.str)
+    return blocks, specs
+
+def attach_arrays(specs):
+    """Attaches to blocks created by share_arrays; returns (blocks, dict name -> numpy array view)"""
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
+
+def map_orf_range(specs, lo, hi):
+    """Finds the exon(s) holding the start of each ORF/transcript pair in [lo, hi).
+
+    exon_end_offset is the running total of exon lengths over all exons, sorted by transcript and
+    then 5' to 3', so an ORF start falls in exon k when end_offset[k-1] < tx_offset + orf_start <= end_offset[k].
+    A start exactly on an exon boundary also matches the next exon, as the prior_size/current_size
+    comparison always has.
+
+    Returns:
+        tuple: (pair index, sorted exon index) numpy arrays
+    """
+    blocks, arrays = attach_arrays(specs)
+    try:
+        end_offset = arrays['exon_end_offset']
+        first, last = arrays['pair_first_exon'][lo:hi], arrays['pair_last_exon'][lo:hi]
+        orf_start = arrays['pair_orf_start'][lo:hi]
+        tx_offset = end_offset[first] - arrays['exon_length'][first]
+        target = tx_offset + orf_start
+        exon = np.maximum(np.searchsorted(end_offset, target, side='left'), first)
+        valid = (orf_start >= 0) & (exon <= last)
+        boundary = valid & (exon < last) & (end_offset[np.minimum(exon, len(end_offset) - 1)] == target)
+        pair = np.arange(lo, hi)
+        pair_idx = np.concatenate([pair[valid], pair[boundary]])
+        exon_idx = np.concatenate([exon[valid], exon[boundary] + 1])
+        return pair_idx, exon_idx
+    finally:
+        for block in blocks:
+            block.close()
+
+def map_orf_starts(exons, orf_coord, pool, num_cores = 12):
+    """Maps ORF start positions in transcript coordinates onto genomic exon coordinates.
+
+    Exon lengths and ORF starts are placed in shared memory once; pool workers only receive
+    index ranges of ORF/transcript pairs and return integer index arrays.
+    """
+    exons = exons[exons['strand'].isin(['+', '-'])]
+    # one segment per transcript, strand and chromosome; exons ordered 5' to 3' within each segment
+    segment, segments = pd.factorize(pd.MultiIndex.from_arrays([exons['strand'], exons['seqname'], exons['transcript_id']]))
+    five_prime = np.where(exons['strand'].to_numpy() == '-', -exons['exon_start'].to_numpy(), exons['exon_start'].to_numpy())
+    exon_order = np.lexsort((five_prime, segment))
+    exon_length = exons['exon_length'].to_numpy(dtype=np.int64)[exon_order]
+    exon_end_offset = np.cumsum(exon_length)
+    sorted_segment = segment[exon_order]
+    segment_first = np.searchsorted(sorted_segment, np.arange(len(segments)), side='left')
+    segment_last = np.searchsorted(sorted_segment, np.arange(len(segments)), side='right') - 1
+
+    # pair every ORF with the segments of its transcript
+    segment_table = pd.DataFrame({'pb_acc': segments.get_level_values(2), 'segment': np.arange(len(segments))})
+    pairs = pd.merge(pd.DataFrame({'pb_acc': orf_coord['pb_acc'].to_numpy(), 'orf_row': np.arange(len(orf_coord))}),
+                     segment_table, on='pb_acc', how='inner')
+    pair_segment = pairs['segment'].to_numpy()
+
+    blocks, specs = share_arrays({
+        'exon_length': exon_length,
+        'exon_end_offset': exon_end_offset,
+        'pair_first_exon': segment_first[pair_segment],
+        'pair_last_exon': segment_last[pair_segment],
+        'pair_orf_start': orf_coord['orf_start'].to_numpy(dtype=np.int64)[pairs['orf_row'].to_numpy()],
+    })
+    try:
+        bounds = np.linspace(0, len(pairs), num = max(num_cores, 1) * 4 + 1, dtype = int)
+        iterable = [(specs, lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        mapped = pool.starmap(map_orf_range, iterable)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    if len(mapped) == 0:
+        logging.warning("no coding start found")
+        return pd.DataFrame(columns = list(orf_coord.columns) + [col for col in exons.columns if col != 'exon_length'] + ['cds_start'])
+    pair_idx = np.concatenate([pair for pair, _ in mapped])
+    exon_idx = np.concatenate([exon for _, exon in mapped])
+
+    # keep the plus-then-minus, chromosome, ORF, exon row order of the per-chromosome mapping
+    orf_row = pairs['orf_row'].to_numpy()[pair_idx]
+    exon_row = exon_order[exon_idx]
+    strand = exons['strand'].to_numpy()[exon_row]
+    seqname = exons['seqname'].to_numpy()[exon_row]
+    chrom_rank = np.zeros(len(exon_row), dtype=np.int64)
+    for csome_strand in ('+', '-'):
+        strand_chroms = pd.unique(exons.loc[exons['strand'] == csome_strand, 'seqname'])
+        on_strand = strand == csome_strand
+        chrom_rank[on_strand] = pd.Index(strand_chroms).get_indexer(seqname[on_strand])
+    order = np.lexsort((exon_row, orf_row, chrom_rank, strand != '+'))
+    orf_row, exon_row, exon_idx = orf_row[order], exon_row[order], exon_idx[order]
+
+    exon_start_offset = exon_end_offset - exon_length
+    prior_size = exon_start_offset[exon_idx] - exon_start_offset[segment_first[sorted_segment[exon_idx]]]
+    orf_exons = pd.concat([orf_coord.iloc[orf_row].reset_index(drop = True),
+                           exons.iloc[exon_row].drop(columns = ['exon_length']).reset_index(drop = True)], axis = 1)
+    start_diff = orf_exons['orf_start'].to_numpy(dtype=np.int64) - prior_size
+    orf_exons['cds_start'] = np.where(orf_exons['strand'] == '+',
+                                      orf_exons['exon_start'] + start_diff - 1,
+                                      orf_exons['exon_end'] - start_diff + 1)
     return orf_exons
 
-def minus_mapping(exons, orf_coord, start_codons, pool, num_cores = 12):
-    minus_exons = exons[exons['strand'] == '-'].copy()
-    start_codons = start_codons[start_codons['strand'] == '-'].copy()
-        
-    orf_chromosomes = minus_exons['seqname'].unique()
-    ref_chromosomes = start_codons['seqname'].unique()
-    
-    accession_map = minus_exons.groupby('seqname')['transcript_id'].apply(list).to_dict()
-    orf_coord_list = [orf_coord[orf_coord['pb_acc'].isin(accession_map[csome])].copy() for csome in orf_chromosomes]
-    exon_list = [minus_exons[minus_exons['seqname'] == csome].copy() for csome in orf_chromosomes]
-    
-    start_codon_list = []
-    for csome in orf_chromosomes:
-        if csome in ref_chromosomes:
-            start_codon_list.append(start_codons[start_codons['seqname'] == csome].copy())
-        else:
-            start_codon_list.append(start_codons.head())
-            
-    
-    iterable = zip(orf_coord_list,exon_list, start_codon_list)    
-    # pool = multiprocessing.Pool(processes = num_cores)
-    minus_orf_list = pool.starmap(minus_mapping_single_chromosome, iterable)
-    if len(minus_orf_list) > 0:
-        minus_orfs = pd.concat(minus_orf_list)
-    else: 
-        minus_orfs = pd.DataFrame(columns = orf_coord.columns)
-    return minus_orfs
-
-def read_orf(filename):
+def lookup_stop_codon_status(ids, stop_codon_index):
+    """Looks up has_stop_codon for a Series of ORF IDs; IDs missing from the fasta are NaN"""
+    id_hashes, has_stop = stop_codon_index
+    if len(id_hashes) == 0:
+        return pd.Series(np.nan, index=ids.index, dtype=object)
+    query = hash_ids(ids)
+    pos = np.searchsorted(id_hashes, query).clip(max=len(id_hashes) - 1)
+    found = id_hashes[pos] == query
+    return pd.Series(has_stop[pos], index=ids.index).where(found)
+
+def read_orf(filename, stop_codon_index=None, chunksize=1000000, accessions=None):
     """
-    Reads the ORF file and formats the column names
+    Reads the ORF file in chunks and formats the column names
     Keep only predictions with score higher than protein-coding threshold
 
+    Each chunk is reduced to the rows orf_mapping can use before it is kept: IDs that do not
+    match ORF_ID_PATTERN are dropped with a warning and, if accessions is given, so are ORFs of
+    other transcripts. Peak memory is NOT bounded by chunksize: the kept rows are concatenated
+    into one table, because orf_calling ranks every ORF of an accession on gencode_atg and
+    upstream_atgs (only known after orf_mapping) and all_orfs_mapped.tsv lists every mapped ORF.
+
     Parameters
     ---------
     filename : str
         location of orf coordinate file
+    stop_codon_index : tuple, optional
+        output of is_orf_called_with_stop_codon; adds has_stop_codon to each chunk as it is read
+    chunksize : int
+        number of rows parsed at a time
+    accessions : set, optional
+        transcript ids to keep ORFs for (those in the sample gtf)
 
     Returns
     --------
     orf: pandas DataFrame
     """
-    orf = pd.read_csv(filename, sep = '\t')
-    orf[['pb_acc', 'misc', 'orf']] = orf['ID'].str.split('_', expand=True)
-    orf['pb_acc'] = orf['pb_acc'].str.split('|').str[0]
-    orf = orf.drop(labels=['misc',], axis=1)
-    orf.columns = ['ID','len', 'orf_strand', 'orf_frame', 'orf_start', 'orf_end', 'orf_len', 'fickett', 'hexamer', 'coding_score', 'pb_acc', 'orf_rank',]
+    chunks = []
+    reader = pd.read_csv(filename, sep = '\t', header = 0, names = ORF_COLUMNS, dtype = ORF_DTYPES, chunksize = chunksize)
+    for chunk in reader:
+        id_parts = chunk['ID'].str.extract(ORF_ID_PATTERN)
+        malformed = id_parts['orf_rank'].isna()
+        if malformed.any():
+            logging.warning(f"Skipping {malformed.sum()} ORFs with IDs not like <pb_acc>_<x>_<rank>, e.g. {chunk.loc[malformed, 'ID'].iloc[0]}")
+        keep = ~malformed
+        if accessions is not None:
+            keep &= id_parts['pb_acc'].isin(accessions)
+        if not keep.all():
+            chunk, id_parts = chunk[keep].copy(), id_parts[keep]
+        chunk['pb_acc'] = id_parts['pb_acc']
+        chunk['orf_rank'] = id_parts['orf_rank'].astype(np.int32)
+        if stop_codon_index is not None:
+            chunk['has_stop_codon'] = lookup_stop_codon_status(chunk['ID'], stop_codon_index)
+        chunks.append(chunk)
+    orf = pd.concat(chunks, ignore_index=True)
     logging.info(f"ORF file read \n{orf.head()}")
     return orf
 
@@ -188,121 +344,148 @@ def orf_calling(orf, num_orfs_per_accession = 1):
     """
     Choose 'best' ORF by examining number of upstream ATG's, match to Gencode Transcript start, and ORF codings
     If a gencode start codon matches an orf, choose the ORF that matches Gencode with the least upstream ATGs
+
+    Ranking is done for all accessions at once with groupby rank, a stable sort and groupby head,
+    rather than one DataFrame operation per accession. Called ORFs are ordered by chromosome
+    (in order of first appearance), then by accession.
     """
-    def call_orf(acc_orfs):
-        score_threshold = 0.364
-        def calling_confidence(row):
-            if row['atg_rank'] == 1 and row['score_rank'] == 1:
-                return 'Clear Best ORF'
-            elif row['coding_score'] <= score_threshold:
-                return 'Low Quality ORF'
-            else:
-                return 'Plausible ORF'
-        
-        acc_orfs['atg_rank'] = acc_orfs['upstream_atgs'].rank(ascending=True)
-        acc_orfs['score_rank'] = acc_orfs['coding_score'].rank(ascending=False)
-        acc_orfs['orf_calling_confidence'] = acc_orfs.apply(lambda row : calling_confidence(row), axis = 1)
-        
-        with_gencode = acc_orfs.dropna(subset=['gencode_atg'])
-        # if start codons match a gencode start, take the gencode with the earliest start codon
-        if len(with_gencode) >= 1:
-            return (with_gencode
-                    .sort_values(by='upstream_atgs')
-                    .reset_index(drop=True)
-                    .head(num_orfs_per_accession)
-            )
-        else:
-            # if no gencode start exists return ORF with best orf_score
-            return (
-                acc_orfs
-                    .sort_values(by='orf_score', ascending=False)
-                    .reset_index(drop=True)
-                    .head(num_orfs_per_accession)
-            )
+    score_threshold = 0.364
     atg_shift = 10       # how much to shift sigmoid for atg score
     atg_growth = 0.5    # how quickly the slope of the sigmoid changes 
-    orf['atg_score'] = orf['upstream_atgs'].apply(lambda x : 1 - 1/( 1+ np.exp(-atg_growth*(x - atg_shift))))
+    orf = orf[orf['pb_acc'].notna()].reset_index(drop=True)
+    orf['atg_score'] = 1 - 1/( 1+ np.exp(-atg_growth*(orf['upstream_atgs'] - atg_shift)))
     # orf['orf_score'] = orf.apply(lambda row: 1 - (1-row['coding_score']*0.99)*(1-row['atg_score']), axis = 1)
     orf['orf_score'] = orf['coding_score']*orf['atg_score']  
-    called_orf = orf.groupby('pb_acc').apply(call_orf).reset_index(drop=True)
 
+    by_acc = orf.groupby('pb_acc')
+    orf['atg_rank'] = by_acc['upstream_atgs'].rank(ascending=True)
+    orf['score_rank'] = by_acc['coding_score'].rank(ascending=False)
+    orf['orf_calling_confidence'] = np.select(
+        [(orf['atg_rank'] == 1) & (orf['score_rank'] == 1), orf['coding_score'] <= score_threshold],
+        ['Clear Best ORF', 'Low Quality ORF'],
+        default='Plausible ORF')
+
+    # if start codons match a gencode start, take the gencode with the earliest start codon
+    # if no gencode start exists take the ORF with best orf_score
+    has_gencode = orf['gencode_atg'].notna()
+    acc_has_gencode = has_gencode.groupby(orf['pb_acc']).transform('any')
+    orf['_call_key'] = np.where(acc_has_gencode, orf['upstream_atgs'], -orf['orf_score'])
+    orf['_chrom_rank'] = pd.factorize(orf['seqname'])[0]
+    candidates = orf[has_gencode | ~acc_has_gencode]
+    called_orf = (
+        candidates
+            .sort_values(by=['_chrom_rank', 'pb_acc', '_call_key'], kind='mergesort')
+            .groupby('pb_acc', sort=False)
+            .head(num_orfs_per_accession)
+            .drop(columns=['_call_key', '_chrom_rank'])
+            .reset_index(drop=True)
+    )
     return called_orf
 
-def orf_calling_multiprocessing(orf, pool, num_orfs_per_accession=1, num_cores = 12):
-    chromosomes = orf['seqname'].unique()
-    orf_split = [orf[orf['seqname'] == csome] for csome in chromosomes]
-    num_orfs_iter = itertools.repeat(num_orfs_per_accession)
-    iterable = zip(orf_split, num_orfs_iter)
-    # pool = multiprocessing.Pool(processes = num_cores)
-    called_orf_list = pool.starmap(orf_calling, iterable)
-    called_orf = pd.concat(called_orf_list)
-    return called_orf
+def parse_conditions(results, parser):
+    """
+    Collects (name, FL columns, output file) for every condition from --condition name=col1,col2
+    and the older --mutant_cols/--output_mutant and --wt_cols/--output_wt pairs
+    """
+    conditions = []
+    for condition in results.condition or []:
+        name, sep, cols = condition.partition('=')
+        if not sep or not name or not cols:
+            parser.error(f"--condition must look like name=col1,col2, got '{condition}'")
+        conditions.append((name, cols.split(','), os.path.join(results.output_dir, f'best_ORF_{name}.tsv')))
+    for name, cols, output in (('mutant', results.mutant_cols, results.output_mutant), ('wt', results.wt_cols, results.output_wt)):
+        if bool(cols) != bool(output):
+            parser.error(f"--{name}_cols and --output_{name} must be given together")
+        if cols:
+            conditions.append((name, cols.split(','), output))
+    if not conditions:
+        parser.error("at least one --condition is required")
+    names = [name for name, _, _ in conditions]
+    if len(set(names)) != len(names):
+        parser.error(f"condition names must be unique: {', '.join(names)}")
+    return conditions
+
+def condition_expression(classification, conditions):
+    """
+    Mean FL and CPM of every condition from one matrix product over the union of FL columns.
+
+    Returns:
+        pandas DataFrame: isoform, FL_<name>, CPM_<name> for each condition
+    """
+    fl_columns = list(dict.fromkeys(col for _, cols, _ in conditions for col in cols))
+    membership = np.zeros((len(fl_columns), len(conditions)))
+    for j, (_, cols, _) in enumerate(conditions):
+        membership[[fl_columns.index(col) for col in cols], j] = 1
+    counts = classification[fl_columns].to_numpy(dtype=float)
+    observed = ~np.isnan(counts)
+    # mean over each condition's columns, skipping missing values like DataFrame.mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fl = np.asfortranarray(np.where(observed, counts, 0) @ membership / (observed @ membership))
+    cpm = fl / np.nansum(fl, axis=0) * 1e6
+    expression = pd.DataFrame({'isoform': classification['isoform'].to_numpy()})
+    for j, (name, _, _) in enumerate(conditions):
+        expression[f'FL_{name}'] = fl[:, j]
+        expression[f'CPM_{name}'] = cpm[:, j]
+    return expression
 
 def main():
     parser = argparse.ArgumentParser(description='Process ORF related file locations')
     parser.add_argument('--orf_coord', '-oc', required=True)
     parser.add_argument('--orf_fasta', '-of', required=True)
+    parser.add_argument('--orf_chunksize', type=int, default=1000000, help="Number of CPAT ORF rows parsed at a time")
     parser.add_argument('--gencode_gtf', '-g', required=True)
+    parser.add_argument('--reference_cache', default=gencode_cache.DEFAULT_CACHE_DIR, help="Directory of compiled GENCODE references")
     parser.add_argument('--sample_gtf', '-sg', required=True)
     parser.add_argument('--pb_gene', '-pg', required=True)
     parser.add_argument('--classification', '-c', required=True)
     parser.add_argument('--sample_fasta', '-sf', required=True)
     parser.add_argument('--num_cores', type=int, default=12)
-    parser.add_argument('--output_mutant', '-om', required=True)
-    parser.add_argument('--output_wt', '-ow', required=True)
-    parser.add_argument('--mutant_cols', required=True, help="Comma-separated list of FL columns for mutant samples")
-    parser.add_argument('--wt_cols', required=True, help="Comma-separated list of FL columns for wild-type samples")
+    parser.add_argument('--condition', action='append', help="name=col1,col2 of FL columns for one condition; repeat for each condition")
+    parser.add_argument('--output_dir', '-od', default='05_orf_calling', help="Directory for best_ORF_<name>.tsv of each --condition")
+    parser.add_argument('--output_mutant', '-om')
+    parser.add_argument('--output_wt', '-ow')
+    parser.add_argument('--mutant_cols', help="Comma-separated list of FL columns for mutant samples")
+    parser.add_argument('--wt_cols', help="Comma-separated list of FL columns for wild-type samples")
     results = parser.parse_args()
 
-    mutant_fl_columns = results.mutant_cols.split(',')
-    wt_fl_columns = results.wt_cols.split(',')
+    conditions = parse_conditions(results, parser)
 
+    # start the shared memory tracker before forking so workers attaching to blocks share the parent's
+    resource_tracker.ensure_running()
     pool = multiprocessing.Pool(processes=results.num_cores)
 
     logging.info("Loading data...")
-    orf_coord = read_orf(results.orf_coord)
+    sample_gtf = read_gtf(results.sample_gtf)
+    sample_accessions = set(sample_gtf.loc[sample_gtf['feature'] == 'exon', 'transcript_id'])
     is_with_stop_codon = is_orf_called_with_stop_codon(results.orf_fasta)
-    orf_coord = pd.merge(orf_coord, is_with_stop_codon, on='ID', how='left')
+    orf_coord = read_orf(results.orf_coord, is_with_stop_codon, results.orf_chunksize, sample_accessions)
 
-    gencode = read_gtf(results.gencode_gtf)
-    sample_gtf = read_gtf(results.sample_gtf)
+    gencode = gencode_cache.load_gtf(results.gencode_gtf, results.reference_cache, features=['start_codon'])
     pb_gene = pd.read_csv(results.pb_gene, sep='\t')
     classification = pd.read_csv(results.classification, sep='\t')
 
-    orf_seq = {rec.id.split('|')[0]: str(rec.seq) for rec in SeqIO.parse(results.sample_fasta, 'fasta')}
+    atg_index = atg_position_index(results.sample_fasta)
 
     logging.info("Mapping orfs to gencode...")
-    all_orfs = orf_mapping(orf_coord, gencode, sample_gtf, orf_seq, pool, results.num_cores)
+    all_orfs = orf_mapping(orf_coord, gencode, sample_gtf, atg_index, pool, results.num_cores)
     all_orfs.to_csv('all_orfs_mapped.tsv', sep='\t', index=False)
 
     logging.info("Calling ORFs...")
-    orfs = orf_calling_multiprocessing(all_orfs, pool, 1, results.num_cores)
+    orfs = orf_calling(all_orfs, 1)
 
     logging.info("Adding metadata...")
-    mutant_classification = classification.copy()
-    mutant_classification['FL'] = mutant_classification[mutant_fl_columns].mean(axis=1)
-    total_mutant_fl = mutant_classification['FL'].sum()
-    mutant_classification['CPM'] = mutant_classification['FL'] / total_mutant_fl * 1e6
-
-    mutant_orfs = pd.merge(orfs, pb_gene, on='pb_acc', how='left')
-    mutant_orfs = pd.merge(mutant_orfs, mutant_classification[['isoform'] + mutant_fl_columns + ['FL', 'CPM']],
-                           left_on='pb_acc', right_on='isoform', how='left').drop(columns=['isoform'])
-
-    wt_classification = classification.copy()
-    wt_classification['FL'] = wt_classification[wt_fl_columns].mean(axis=1)
-    total_wt_fl = wt_classification['FL'].sum()
-    wt_classification['CPM'] = wt_classification['FL'] / total_wt_fl * 1e6
-
-    wt_orfs = pd.merge(orfs, pb_gene, on='pb_acc', how='left')
-    wt_orfs = pd.merge(wt_orfs, wt_classification[['isoform'] + wt_fl_columns + ['FL', 'CPM']],
-                       left_on='pb_acc', right_on='isoform', how='left').drop(columns=['isoform'])
+    expression = condition_expression(classification, conditions)
+    orfs_meta = pd.merge(orfs, pb_gene, on='pb_acc', how='left')
+    orfs_meta = pd.merge(orfs_meta, expression, left_on='pb_acc', right_on='isoform', how='left').drop(columns=['isoform'])
 
     logging.info("Saving results...")
-    columns_to_save = [col for col in orfs.columns if col in mutant_orfs.columns]
+    columns_to_save = [col for col in orfs.columns if col in orfs_meta.columns]
     columns_to_save += ['gene', 'FL', 'CPM', 'has_stop_codon']
 
-    mutant_orfs[columns_to_save].to_csv(results.output_mutant, index=False, sep="\t")
-    wt_orfs[columns_to_save].to_csv(results.output_wt, index=False, sep="\t")
+    for name, _, output in conditions:
+        condition_orfs = orfs_meta[[f'{col}_{name}' if col in ('FL', 'CPM') else col for col in columns_to_save]]
+        condition_orfs.columns = columns_to_save
+        condition_orfs.to_csv(output, index=False, sep="\t")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
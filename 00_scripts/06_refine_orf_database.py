@@ -2,12 +2,34 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import numpy as np
 from Bio import SeqIO
 from Bio import Seq
-from collections import defaultdict
+from Bio.Data import CodonTable
 import argparse
+import hashlib
 import logging
 import os
+from fasta_partition import partition_fasta
+
+# nucleotide byte -> 0-3 (A, C, G, T/U), anything else -> 4
+BASE_CODES = np.full(256, 4, dtype=np.int64)
+for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+
+def build_codon_table(table_id=1):
+    """Amino acid byte for each of the 64 codon indices 16*b1 + 4*b2 + b3, with b'*' for stops"""
+    table = CodonTable.unambiguous_dna_by_id[table_id]
+    codon_table = np.zeros(64, dtype=np.uint8)
+    for i, b1 in enumerate('ACGT'):
+        for j, b2 in enumerate('ACGT'):
+            for k, b3 in enumerate('ACGT'):
+                codon = b1 + b2 + b3
+                codon_table[16*i + 4*j + k] = ord('*') if codon in table.stop_codons else ord(table.forward_table[codon])
+    return codon_table
+
+CODON_TABLE = build_codon_table()
 
 def get_accession_seqs(seqs):
     logging.info('Getting accession sequences...')
@@ -22,18 +44,90 @@ def get_accession_seqs(seqs):
             pb_seqs[pb_acc] = seq
     return pb_seqs, redundant_accs
 
-def combine_by_sequence(orfs, pb_seqs):
-    logging.info('Combining by sequence...')
-    orfs = orfs[['pb_acc', 'orf_start', 'orf_end', 'orf_len']]
-    pb_pseqs = defaultdict(list)
-    for _, row in orfs.iterrows():
-        pb_acc, start, end, _ = row
+def translate_orfs(orf_seqs):
+    """
+    Translates a batch of ORF nucleotide sequences up to the first stop codon, like Seq.translate(to_stop=True).
+    ACGT sequences are translated together through CODON_TABLE; sequences with any other
+    character (N, IUPAC codes, gaps) fall back to Biopython.
+
+    Returns a list of protein sequences as bytes.
+    """
+    if not orf_seqs:
+        return []
+    lengths = np.array([len(seq) for seq in orf_seqs], dtype=np.int64)
+    nts = BASE_CODES[np.frombuffer(''.join(orf_seqs).encode('ascii', 'replace'), dtype=np.uint8)]
+    nt_starts = np.cumsum(lengths) - lengths
+    orf_of_nt = np.repeat(np.arange(len(orf_seqs)), lengths)
+    is_ambiguous = np.bincount(orf_of_nt, weights=(nts == 4), minlength=len(orf_seqs)) > 0
+
+    num_codons = lengths // 3
+    codon_starts = np.cumsum(num_codons) - num_codons
+    orf_of_codon = np.repeat(np.arange(len(orf_seqs)), num_codons)
+    codon_rank = np.arange(len(orf_of_codon)) - codon_starts[orf_of_codon]
+    pos = nt_starts[orf_of_codon] + 3*codon_rank
+    codons = (16*nts[pos] + 4*nts[pos + 1] + nts[pos + 2]) if len(pos) else pos
+    aas = CODON_TABLE[np.where(codons < 64, codons, 0)]
+
+    # protein length is the number of codons before the first stop
+    protein_lengths = num_codons.copy()
+    is_stop = aas == ord('*')
+    stop_orfs, first_stop = np.unique(orf_of_codon[is_stop], return_index=True)
+    protein_lengths[stop_orfs] = codon_rank[is_stop][first_stop]
+
+    aa_bytes = aas.tobytes()
+    proteins = []
+    for i, (codon_start, protein_length) in enumerate(zip(codon_starts.tolist(), protein_lengths.tolist())):
+        if is_ambiguous[i]:
+            proteins.append(Seq.translate(orf_seqs[i], to_stop=True).encode('ascii'))
+        else:
+            proteins.append(aa_bytes[codon_start:codon_start + protein_length])
+    return proteins
+
+def iter_orf_batches(orfs, pb_seqs, batch_size):
+    """Yields lists of (pb_acc, orf_start, orf_end, ORF nucleotide sequence) for ORFs whose transcript sequence is known"""
+    batch = []
+    for pb_acc, start, end in zip(orfs['pb_acc'], orfs['orf_start'], orfs['orf_end']):
         seq = pb_seqs.get(pb_acc)
         if seq:
-            orf_seq = seq[start-1:end]
-            prot_seq = Seq.translate(orf_seq, to_stop=True)
-            pb_pseqs[prot_seq].append(pb_acc)
-    return pb_pseqs
+            batch.append((pb_acc, start, end, seq[start-1:end]))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def combine_by_sequence(orfs, pb_seqs, batch_size=100000):
+    """
+    Groups ORFs that translate to the same protein.
+
+    Proteins are keyed by a 128-bit digest instead of the sequence itself, and each group
+    only keeps the coordinates of its first ORF so the protein can be translated again
+    when it is written.
+
+    Returns:
+        list: [orf_start, orf_end, list of pb_accs] per protein, in order of first appearance
+    """
+    logging.info('Combining by sequence...')
+    orfs = orfs[['pb_acc', 'orf_start', 'orf_end', 'orf_len']]
+    groups = {}
+    for batch in iter_orf_batches(orfs, pb_seqs, batch_size):
+        proteins = translate_orfs([orf_seq for _, _, _, orf_seq in batch])
+        for (pb_acc, start, end, _), protein in zip(batch, proteins):
+            digest = hashlib.blake2b(protein, digest_size=16).digest()
+            group = groups.get(digest)
+            if group is None:
+                groups[digest] = [start, end, [pb_acc]]
+            else:
+                group[2].append(pb_acc)
+    return list(groups.values())
+
+def iter_combined_sequences(groups, pb_seqs, batch_size=100000):
+    """Yields (protein sequence, pb_accs) for each group from combine_by_sequence"""
+    for i in range(0, len(groups), batch_size):
+        batch = groups[i:i + batch_size]
+        proteins = translate_orfs([pb_seqs[accs[0]][start-1:end] for start, end, accs in batch])
+        for protein, (_, _, accs) in zip(proteins, batch):
+            yield protein.decode('ascii'), accs
 
 def order_pb_acc_numerically(accs):
     accs_numerical = []
@@ -56,10 +150,7 @@ def write_dropout_files(dropout_ids, input_fasta, dropout_orfs, output_prefix):
     dropout_fasta = f"{os.path.dirname(output_prefix)}/dropout_{os.path.basename(output_prefix)}_orf.fasta"
     dropout_tsv = f"{os.path.dirname(output_prefix)}/dropout_{os.path.basename(output_prefix)}_orf.tsv"
 
-    with open(dropout_fasta, "w") as out_f:
-        for record in SeqIO.parse(input_fasta, "fasta"):
-            if record.id.split("|")[0] in dropout_ids:
-                SeqIO.write(record, out_f, "fasta")
+    partition_fasta(input_fasta, [(dropout_fasta, dropout_ids)], key=lambda acc: acc.split("|")[0])
 
     dropout_orfs.to_csv(dropout_tsv, sep="\t", index=False)
 
@@ -95,7 +186,7 @@ def main():
 
     with open(combined_tsv, "w") as ofile, open(combined_fasta, "w") as ofile2:
         ofile.write("protein_sequence\tpb_accs\n")
-        for seq, accs in pb_pseqs.items():
+        for seq, accs in iter_combined_sequences(pb_pseqs, pb_seqs):
             accs_sorted = order_pb_acc_numerically(accs)
             accs_str = "|".join(accs_sorted)
             ofile.write(seq + "\t" + accs_str + "\n")
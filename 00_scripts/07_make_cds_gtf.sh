@@ -24,28 +24,16 @@ source $(conda info --base)/etc/profile.d/conda.sh
 
 conda activate reference_tab
 
-# condition1
+# all conditions from one parse of the sample GTF, one --condition (agg_orfs, refined_orfs, output_cds) per condition
 # Command to open the container & run script
 
 apptainer exec /project/sheynkman/dockers/LRP/pb-cds-gtf_latest.sif /bin/bash -c " \
     python 00_scripts/07_make_pacbio_cds_gtf.py \
     --sample_gtf 03_filter_sqanti/sample_corrected.5degfilter.gff \
-    --agg_orfs 06_refine_orf_database/condition1_0_orf_refined.tsv \
-    --refined_orfs 05_orf_calling/best_ORF_condition1.tsv \
     --pb_gene 04_transcriptome_summary/pb_gene.tsv \
-    --output_cds 07_make_cds_gtf/condition1_cds.gtf
-"
-
-# condition2
-# Command to open the container & run script
-
-apptainer exec /project/sheynkman/dockers/LRP/pb-cds-gtf_latest.sif /bin/bash -c " \
-    python 00_scripts/07_make_pacbio_cds_gtf.py \
-    --sample_gtf 03_filter_sqanti/sample_corrected.5degfilter.gff \
-    --agg_orfs 06_refine_orf_database/condition2_0_orf_refined.tsv \
-    --refined_orfs 05_orf_calling/best_ORF_condition2.tsv \
-    --pb_gene 04_transcriptome_summary/pb_gene.tsv \
-    --output_cds 07_make_cds_gtf/condition2_cds.gtf
+    --condition 06_refine_orf_database/condition1_0_orf_refined.tsv 05_orf_calling/best_ORF_condition1.tsv 07_make_cds_gtf/condition1_cds.gtf \
+    --condition 06_refine_orf_database/condition2_0_orf_refined.tsv 05_orf_calling/best_ORF_condition2.tsv 07_make_cds_gtf/condition2_cds.gtf \
+    --cpus 2
 "
 
 conda deactivate
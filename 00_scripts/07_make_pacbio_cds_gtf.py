@@ -4,35 +4,54 @@
 # input - pacbio gtf, orf calls, pb_gene
 # output - pacbio gtf with added "cds" features (orfs)
 
+import numpy as np
 import pandas as pd
-from collections import defaultdict
-import copy
 import argparse
+import multiprocessing
 import gtfparse
 
-def get_first_block_index(orf_coord, cblens):
-    # get the index corresponding to the first block containing the orf start
-    # return index, and the delta (spacing upstream of end)
-    for i, cblen in enumerate(cblens):
-        if orf_coord <= cblen:
-            delta = cblen - orf_coord
-            return i, delta
-
-def make_coords_trimmed_to_orf_range(i1, delta1, i2, delta2, coords):
-    orf_coords = copy.deepcopy(coords)
-    orf_coords = orf_coords[i1: i2+1]
-    # trim ends to orf start/end
-    orf_coords[0][0] = orf_coords[0][1] - delta1
-    orf_coords[-1][1] = orf_coords[-1][1] - delta2
-    return orf_coords
-
-def make_coords_trimmed_to_orf_range_neg_strand(i1, delta1, i2, delta2, coords):
-    orf_coords = copy.deepcopy(coords)
-    orf_coords = orf_coords[i1: i2+1]
-    # trim ends to orf start/end
-    orf_coords[0][1] = orf_coords[0][0] + delta1
-    orf_coords[-1][0] = orf_coords[-1][0] + delta2
-    return orf_coords
+def exon_blocks(gtf):
+    """
+    Exon blocks of every transcript in CSR layout.
+
+    Blocks are ordered by transcript, then 5' to 3' (ascending coordinates on '+', descending on '-').
+    Returns (accessions, chroms, strands, indptr, starts, ends, cblens), where the blocks of
+    transcript t are rows indptr[t]:indptr[t+1] and cblens are the cumulative block lengths
+    over all transcripts (monotonic, so it can be searched directly).
+    """
+    codes, accs = pd.factorize(gtf['acc'])
+    starts = gtf['start'].to_numpy(dtype=np.int64)
+    ends = gtf['end'].to_numpy(dtype=np.int64)
+    sign = np.where(gtf['strand'].to_numpy() == '-', -1, 1)
+    order = np.lexsort((sign * ends, sign * starts, codes))
+    starts, ends = starts[order], ends[order]
+    indptr = np.zeros(len(accs) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(codes, minlength=len(accs)))
+    first = order[indptr[:-1]]
+    chroms = gtf['chr'].to_numpy()[first]
+    strands = gtf['strand'].to_numpy()[first]
+    cblens = np.cumsum(ends - starts + 1)
+    return accs, chroms, strands, indptr, starts, ends, cblens
+
+def get_block_index(orf_coords, tx_index, indptr, cblens):
+    """
+    Index of the block containing each orf coordinate (1-based, on the transcript) and
+    the delta (spacing upstream of the block end)
+    """
+    if np.any(orf_coords < 1):
+        # would otherwise land in the previous transcript's last block
+        raise ValueError('ORF coordinates must be 1-based positions on their transcript')
+    offsets = np.concatenate(([0], cblens))[indptr[tx_index]]
+    targets = orf_coords + offsets
+    idx = np.searchsorted(cblens, targets, side='left')
+    if np.any(idx >= indptr[tx_index + 1]):
+        raise ValueError('ORF coordinates extend past the end of their transcript')
+    return idx, cblens[idx] - targets
+
+def expand_ranges(first, counts):
+    # concatenation of range(first[i], first[i] + counts[i]) over i
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(first, counts) + np.arange(offsets.size) - offsets
 
 def ceiling_cpm(cpm):
     # gtf top score is 1000
@@ -41,6 +60,18 @@ def ceiling_cpm(cpm):
     else:
         return cpm
 
+# inputs shared by all conditions, set by make_pacbio_cds_gtfs before any worker is forked
+shared_inputs = {}
+
+def read_exon_blocks(sample_gtf):
+    # import gtf, only exon info.
+    gtf = gtfparse.read_gtf(sample_gtf)
+
+    gtf = gtf[['seqname', 'feature', 'start', 'end', 'strand', 'transcript_id']]
+    gtf = gtf[gtf['feature'] == 'exon']
+    gtf.columns = ['chr', 'feat', 'start', 'end', 'strand', 'acc']
+    return exon_blocks(gtf)
+
 def make_pacbio_cds_gtf(sample_gtf, agg_orfs, refined_orfs, pb_gene, output_cds):
     """
     sample_gtf : filename
@@ -49,72 +80,84 @@ def make_pacbio_cds_gtf(sample_gtf, agg_orfs, refined_orfs, pb_gene, output_cds)
     pb_gene : filename
     output_cds : filename
     """
-    # import gtf, only exon info.
-    gtf = gtfparse.read_gtf(sample_gtf)
+    make_pacbio_cds_gtfs(sample_gtf, pb_gene, [(agg_orfs, refined_orfs, output_cds)])
 
-    gtf = gtf[['seqname', 'feature', 'start', 'end', 'strand', 'transcript_id']]
-    gtf = gtf[gtf['feature'] == 'exon']
-    gtf.columns = ['chr', 'feat', 'start', 'end', 'strand', 'acc']
+def make_pacbio_cds_gtfs(sample_gtf, pb_gene, conditions, cpus=1):
+    """
+    Write the CDS GTF of several conditions from one parse of the sample GTF
+    sample_gtf : filename
+    pb_gene : filename
+    conditions : list of (agg_orfs, refined_orfs, output_cds) filenames
+    cpus : number of conditions written in parallel
+    """
+    # read in pb to genename
+    pb_gene = pd.read_table(pb_gene)
+    pb_gene = pd.Series(pb_gene.gene.values, index=pb_gene.pb_acc).to_dict()
+
+    shared_inputs['blocks'] = read_exon_blocks(sample_gtf)
+    shared_inputs['pb_gene'] = pb_gene
+    try:
+        if cpus > 1 and len(conditions) > 1:
+            # forked workers inherit the exon blocks instead of receiving a pickled copy
+            with multiprocessing.get_context('fork').Pool(min(cpus, len(conditions))) as pool:
+                pool.map(write_condition_cds_gtf, conditions)
+        else:
+            for condition in conditions:
+                write_condition_cds_gtf(condition)
+    finally:
+        shared_inputs.clear()
+
+def write_condition_cds_gtf(condition):
+    """
+    Write the CDS GTF of one condition, given as (agg_orfs, refined_orfs, output_cds) filenames
+    """
+    agg_orfs, refined_orfs, output_cds = condition
+    accs, chroms, strands, indptr, starts, ends, cblens = shared_inputs['blocks']
+    pb_gene = shared_inputs['pb_gene']
 
     # only move forward with "base accession" (representative pb)
     repr_pbs = pd.read_table(agg_orfs)['base_acc'].to_list()
-    gtf = gtf[gtf.acc.isin(repr_pbs)]
-
-    # pb coords into dict
-    pbs = defaultdict(lambda: ['chr', 'strand', [], [], []]) # pb -> [chr, strand, [start, end], [block lengths], [cum. block lengths]]
-    for i, row in gtf.iterrows():
-        chr, feat, start, end, strand, acc = row
-        pbs[acc][0] = chr
-        pbs[acc][1] = strand
-        pbs[acc][2].append([int(start), int(end)])
-
-    # sort all coords, calc blocks
-    def make_cumulative_blens(blocks):
-        cblocks = []
-        cbl = 0 # cumulative block length
-        for b in blocks:
-            cbl += b
-            cblocks.append(cbl)
-        return cblocks
-    
-    for acc, infos in pbs.items():
-        strand = infos[1]
-        if strand == '+':
-            infos[2] = sorted(infos[2])
-        elif strand == '-':
-            infos[2] = sorted(infos[2], reverse=True)
-        infos[3] = [end-start+1 for [start, end] in infos[2]]
-        infos[4] = make_cumulative_blens(infos[3])
 
     # read in the ranges of orf on pb transcripts
     ranges = pd.read_table(refined_orfs)[['pb_acc', 'orf_start', 'orf_end', 'CPM']]
 
-    # read in pb to genename
-    pb_gene = pd.read_table(pb_gene)
-    pb_gene = pd.Series(pb_gene.gene.values, index=pb_gene.pb_acc).to_dict()
+    # only continue with representative pb isoforms that have exons and align to a genetic locus
+    ranges['tx'] = pd.Index(accs).get_indexer(ranges['pb_acc'])
+    ranges['gene'] = ranges['pb_acc'].map(pb_gene).fillna('-')
+    ranges = ranges[ranges['pb_acc'].isin(repr_pbs) & (ranges['tx'] >= 0) & (ranges['gene'] != '-')].reset_index(drop=True)
+    tx = ranges['tx'].to_numpy()
+    i1, delta1 = get_block_index(ranges['orf_start'].to_numpy(dtype=np.int64), tx, indptr, cblens)
+    i2, delta2 = get_block_index(ranges['orf_end'].to_numpy(dtype=np.int64), tx, indptr, cblens)
+
+    # one output line per exon block, then per orf block, of each orf
+    orf_index = np.arange(len(tx))
+    n_exons = indptr[tx + 1] - indptr[tx]
+    n_cds = i2 - i1 + 1
+    line_orf = np.concatenate((np.repeat(orf_index, n_exons), np.repeat(orf_index, n_cds)))
+    line_block = np.concatenate((expand_ranges(indptr[tx], n_exons), expand_ranges(i1, n_cds)))
+    is_cds = np.repeat([False, True], [n_exons.sum(), n_cds.sum()])
+    order = np.lexsort((is_cds, line_orf))
+    line_orf, line_block, is_cds = line_orf[order], line_block[order], is_cds[order]
+
+    # trim the first/last orf block to the orf start/end (on '-' the first block is trimmed at its end)
+    line_start = starts[line_block]
+    line_end = ends[line_block]
+    plus = strands[tx[line_orf]] != '-'
+    orf_first = is_cds & (line_block == i1[line_orf])
+    orf_last = is_cds & (line_block == i2[line_orf])
+    line_start = np.where(plus & orf_first, ends[line_block] - delta1[line_orf], line_start)
+    line_end = np.where(plus & orf_last, ends[line_block] - delta2[line_orf], line_end)
+    line_end = np.where(~plus & orf_first, starts[line_block] + delta1[line_orf], line_end)
+    line_start = np.where(~plus & orf_last, starts[line_block] + delta2[line_orf], line_start)
 
+    # write out the coordinates
+    acc_w_gene_w_cpm = ranges['gene'] + '|' + ranges['pb_acc'] + '|' + ranges['CPM'].astype(str)
+    out_acc = ('gene_id "' + ranges['gene'] + '"; transcript_id "' + acc_w_gene_w_cpm + '";').to_numpy()
+    lines = (pd.Series(chroms[tx[line_orf]]) + '\tmm39_canon\t' + np.where(is_cds, 'CDS', 'exon') + '\t'
+             + line_start.astype(str) + '\t' + line_end.astype(str) + '\t.\t'
+             + strands[tx[line_orf]] + '\t.\t' + out_acc[line_orf] + '\n')
     with open(output_cds, 'w') as ofile:
-        for i, row in ranges.iterrows():
-            acc, orf_start, orf_end, cpm = row
-            if acc in pbs:
-                gene = pb_gene.get(acc, '-')
-                # only continue with pb isoforms that align to a genetic locus
-                if gene == '-': continue
-                infos = pbs[acc]
-                chr, strand, coords, blens, cblens = infos
-                i1, delta1 = get_first_block_index(orf_start, cblens)
-                i2, delta2 = get_first_block_index(orf_end, cblens)
-                if strand == '+':
-                    orf_coords = make_coords_trimmed_to_orf_range(i1, delta1, i2, delta2, coords)
-                elif strand == '-':
-                    orf_coords = make_coords_trimmed_to_orf_range_neg_strand(i1, delta1, i2, delta2, coords)
-                # write out the coordinates
-                acc_w_gene_w_cpm = gene + '|' + acc + '|' + str(cpm)
-                out_acc = 'gene_id "{}"; transcript_id "{}";'.format(gene, acc_w_gene_w_cpm)
-                for [start, end] in coords:
-                    ofile.write('\t'.join([chr, 'mm39_canon', 'exon', str(start), str(end), '.', strand, '.', out_acc]) + '\n')
-                for [start, end] in orf_coords:
-                    ofile.write('\t'.join([chr, 'mm39_canon', 'CDS', str(start), str(end), '.', strand, '.', out_acc]) + '\n')
+        ofile.write(''.join(lines))
 
 def main():
     parser = argparse.ArgumentParser("IO file locations for make pacbio cds gtf")
@@ -123,8 +166,17 @@ def main():
     parser.add_argument("--refined_orfs", action="store", dest="refined_orfs")
     parser.add_argument("--pb_gene", action="store", dest="pb_gene")
     parser.add_argument("--output_cds", action="store", dest="output_cds")
+    parser.add_argument("--condition", action="append", nargs=3, dest="conditions", default=[],
+                        metavar=("AGG_ORFS", "REFINED_ORFS", "OUTPUT_CDS"),
+                        help="agg_orfs, refined_orfs and output_cds of one condition; repeat for each condition")
+    parser.add_argument("--cpus", action="store", dest="cpus", type=int, default=1, help="Number of conditions written in parallel")
     results = parser.parse_args()
-    make_pacbio_cds_gtf(results.sample_gtf, results.agg_orfs, results.refined_orfs, results.pb_gene, results.output_cds)
+    conditions = [tuple(condition) for condition in results.conditions]
+    if results.output_cds is not None:
+        conditions.insert(0, (results.agg_orfs, results.refined_orfs, results.output_cds))
+    if not conditions:
+        parser.error("give --agg_orfs/--refined_orfs/--output_cds or at least one --condition")
+    make_pacbio_cds_gtfs(results.sample_gtf, results.pb_gene, conditions, results.cpus)
     
 if __name__ == "__main__":
     main()
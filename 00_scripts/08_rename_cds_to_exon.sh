@@ -1,7 +1,7 @@
 #!/bin/bash
 
 #SBATCH --job-name=08_rename_cds_to_exon
-#SBATCH --cpus-per-task=10 #number of cores to use
+#SBATCH --cpus-per-task=3 #number of cores to use
 #SBATCH --nodes=1
 #SBATCH --ntasks-per-node=1
 #SBATCH --time=12:00:00 #amount of time for the whole job
@@ -28,7 +28,7 @@ apptainer exec /project/sheynkman/dockers/LRP/pb-cds-gtf_latest.sif /bin/bash -c
   --sample2_name 08_rename_cds_to_exon/condition2 \
   --reference_gtf /project/sheynkman/external_data/GENCODE_v47/gencode.v47.basic.annotation.gtf \
   --reference_name 08_rename_cds_to_exon/gencode \
-  --num_cores 8 
+  --num_cores 3 
 "
 
 conda deactivate 
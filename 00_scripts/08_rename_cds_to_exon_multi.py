@@ -7,64 +7,10 @@ import re
 import argparse
 import gtfparse
 import multiprocessing
+import os
+import shutil
 
-#%%
-REQUIRED_COLUMNS = [
-    "seqname",
-    "source",
-    "feature",
-    "start",
-    "end",
-    "score",
-    "strand",
-    "frame",
-]
-#%%
-def make_attribute_column(row):
-    attribute = ''
-    for i in row.index:
-        if i not in REQUIRED_COLUMNS and row[i] != '':
-            tmp = f'{i} "{row[i]}"; '
-            attribute = attribute + tmp
-    attribute = attribute.strip()
-    return attribute
-#%%
-def set_transcript_ranges(group):
-    exons = group.query('feature == "exon"')
-    if len(exons) == 0:
-        return group
-    exon_min = min( min(exons['start']), min(exons['end']))
-    exon_max = max( max(exons['start']), max(exons['end']))
-    group.loc[group.feature == 'transcript', 'start'] = exon_min
-    group.loc[group.feature == 'transcript', 'end'] = exon_max
-    return group
-
-
-def transform_cds(gtf):
-    # only keep transcript and CDS rows
-    gtf_cds = gtf.query('feature in ["transcript","CDS"]').copy()  # Make a copy
-    # rename CDS to exon and update transcript range
-    gtf_cds.loc[gtf_cds['feature'] == 'CDS', 'feature'] = 'exon'  # Use .loc to modify DataFrame
-    gtf_cds = gtf_cds.groupby('transcript_id').apply(set_transcript_ranges)
-    # only keep transcripts that have a CDS
-    sizes = gtf_cds.groupby('transcript_id').size()
-    transcripts_with_cds = list(sizes[sizes > 1].index)
-    gtf_cds = gtf_cds[gtf_cds['transcript_id'].isin(transcripts_with_cds)]  # Use .isin() to filter DataFrame
-    return gtf_cds
-
-
-
-#%%
-
-#!/usr/bin/env python3
-#%%
-import pandas as pd
-import numpy as np
-import csv
-import re
-import argparse
-import gtfparse
-import multiprocessing
+from gencode_cache import DEFAULT_CACHE_DIR, file_hash
 
 #%%
 REQUIRED_COLUMNS = [
@@ -77,66 +23,101 @@ REQUIRED_COLUMNS = [
     "strand",
     "frame",
 ]
+CDS_SUFFIX = 'cds_renamed_exon.gtf'
+EXON_SUFFIX = 'transcript_exons_only.gtf'
+# part of the reference cache key; bump when the written reference outputs change
+RENAME_FORMAT_VERSION = 'v2'
 
 #%%
-def make_attribute_column(row):
-    attribute = ''
-    for i in row.index:
-        if i not in REQUIRED_COLUMNS and row[i] != '':
-            tmp = f'{i} "{row[i]}"; '
-            attribute = attribute + tmp
-    attribute = attribute.strip()
-    return attribute
+def make_attribute_column(gtf):
+    """
+    Attribute strings ('key "value"; ...') of all rows, built one attribute column at a time.
+    Empty values are skipped.
+    """
+    attribute = np.full(len(gtf), '', dtype=object)
+    for column in gtf.columns:
+        if column in REQUIRED_COLUMNS:
+            continue
+        values = gtf[column]
+        present = (values != '').to_numpy()
+        field = (f'{column} "' + values.astype(str) + '"; ').to_numpy()
+        attribute[present] = attribute[present] + field[present]
+    return pd.Series(attribute, index=gtf.index, dtype=object).str.strip()
+
+def write_gtf(gtf, filename, chunksize=100000):
+    """
+    Write the required columns and the attribute column of gtf, one chunk of rows at a time
+    """
+    with open(filename, 'w', newline='') as handle:
+        for start in range(0, len(gtf), chunksize):
+            chunk = gtf.iloc[start:start + chunksize]
+            out = chunk.filter(REQUIRED_COLUMNS).assign(attribute=make_attribute_column(chunk).to_numpy())
+            out.to_csv(handle, sep='\t', index=False, header=False, quoting=csv.QUOTE_NONE)
 
 #%%
-def set_transcript_ranges(group):
-    exons = group.query('feature == "exon"')
-    if len(exons) == 0:
-        return group
-    exon_min = min(min(exons['start']), min(exons['end']))
-    exon_max = max(max(exons['start']), max(exons['end']))
-    group.loc[group.feature == 'transcript', 'start'] = exon_min
-    group.loc[group.feature == 'transcript', 'end'] = exon_max
-    return group
+def set_transcript_ranges(gtf):
+    """
+    Set the start/end of each transcript row to the range spanned by the exon rows of its transcript.
+    Transcripts without exon rows are left as they are.
+    """
+    exons = gtf[gtf['feature'] == 'exon']
+    exon_ranges = pd.DataFrame({'transcript_id': exons['transcript_id'],
+                                'low': np.minimum(exons['start'], exons['end']),
+                                'high': np.maximum(exons['start'], exons['end'])})
+    exon_ranges = exon_ranges.groupby('transcript_id').agg(exon_min=('low', 'min'), exon_max=('high', 'max'))
+    is_transcript = (gtf['feature'] == 'transcript').to_numpy()
+    transcripts = gtf.loc[is_transcript, ['transcript_id']].join(exon_ranges, on='transcript_id')
+    has_exons = transcripts['exon_min'].notna().to_numpy()
+    rows = np.flatnonzero(is_transcript)[has_exons]
+    for column, value in (('start', 'exon_min'), ('end', 'exon_max')):
+        coords = gtf[column].to_numpy().copy()
+        coords[rows] = transcripts[value].to_numpy()[has_exons]
+        gtf[column] = coords
+    return gtf
 
 def transform_cds(gtf):
     gtf_cds = gtf.query('feature in ["transcript","CDS"]').copy()
     gtf_cds.loc[gtf_cds['feature'] == 'CDS', 'feature'] = 'exon'
-    gtf_cds = gtf_cds.groupby('transcript_id').apply(set_transcript_ranges)
-    sizes = gtf_cds.groupby('transcript_id').size()
-    transcripts_with_cds = list(sizes[sizes > 1].index)
-    gtf_cds = gtf_cds[gtf_cds['transcript_id'].isin(transcripts_with_cds)]
+    gtf_cds = set_transcript_ranges(gtf_cds)
+    # only keep transcripts that have a CDS
+    sizes = gtf_cds['transcript_id'].map(gtf_cds['transcript_id'].value_counts())
+    gtf_cds = gtf_cds[(sizes > 1).to_numpy()]
     return gtf_cds
 
-def process_gtf_single(sample):
-    transformed = transform_cds(sample)
-    transformed['attribute'] = transformed.apply(make_attribute_column, axis=1)
-    transformed = transformed.filter(REQUIRED_COLUMNS + ['attribute'])
-    return transformed
-
-def process_gtf_multiprocess(sample, name, num_cores):
-    # transform cds info
+def process_gtf(sample, name):
+    # transform cds info, one chromosome at a time
     chromosomes = sample['seqname'].unique()
-    sample_split = [sample[sample['seqname'] == csome] for csome in chromosomes]
-    pool = multiprocessing.Pool(processes=num_cores)
-    sample_cds_split = pool.map(process_gtf_single, sample_split)
-    sample_cds = pd.concat(sample_cds_split)
-    sample_cds.to_csv(f'{name}.cds_renamed_exon.gtf', sep='\t', index=False, header=False, quoting=csv.QUOTE_NONE)
-    
-    #make attribute column for exon df
-    sample['attribute'] = sample.apply(make_attribute_column, axis=1)
-    sample = sample.filter(REQUIRED_COLUMNS + ['attribute'])
+    sample_cds = pd.concat([transform_cds(sample[sample['seqname'] == csome]) for csome in chromosomes])
+    write_gtf(sample_cds, f'{name}.{CDS_SUFFIX}')
+
+    # transcript and exon rows, attribute column built while writing
     sample_exon = sample.query('feature in ["transcript","exon"]')
-    sample_exon.to_csv(f'{name}.transcript_exons_only.gtf', sep='\t', index=False, header=False, quoting=csv.QUOTE_NONE)
+    write_gtf(sample_exon, f'{name}.{EXON_SUFFIX}')
 
-def process_sample_rename(sample_file, name, num_cores):
+def process_sample_rename(sample_file, name):
     sample = gtfparse.read_gtf(sample_file)
     sample['transcript_id'] = sample['transcript_id'].apply(lambda x: x.split('|')[1])
-    process_gtf_multiprocess(sample, name, num_cores)
-
-def process_reference_rename(reference_file, name, num_cores):
-    ref = gtfparse.read_gtf(reference_file)
-    process_gtf_multiprocess(ref, name, num_cores)
+    process_gtf(sample, name)
+
+def process_reference_rename(reference_file, name, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    The reference outputs only depend on the reference GTF, so they are built once per file
+    (keyed by its content hash and RENAME_FORMAT_VERSION) in cache_dir and copied to name.* for each run
+    """
+    key = os.path.join(cache_dir, f"{os.path.basename(reference_file)}.{file_hash(reference_file)[:16]}.{RENAME_FORMAT_VERSION}")
+    suffixes = [CDS_SUFFIX, EXON_SUFFIX]
+    if all(os.path.exists(f'{key}.{suffix}') for suffix in suffixes):
+        print(f"Using cached reference outputs {key}.*")
+    else:
+        ref = gtfparse.read_gtf(reference_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write under a temporary name so a concurrent run never reads a partial file
+        tmp_key = f'{key}.{os.getpid()}.tmp'
+        process_gtf(ref, tmp_key)
+        for suffix in suffixes:
+            os.replace(f'{tmp_key}.{suffix}', f'{key}.{suffix}')
+    for suffix in suffixes:
+        shutil.copyfile(f'{key}.{suffix}', f'{name}.{suffix}')
 
 def main():
     parser = argparse.ArgumentParser(description='rename cds to exon for sqanti protein module')
@@ -146,14 +127,18 @@ def main():
     parser.add_argument('--sample2_name', action='store', dest='sample2_name', help='second sample name')
     parser.add_argument('--reference_gtf', action='store', dest='reference_gtf', help='reference gtf file')
     parser.add_argument('--reference_name', action='store', dest='reference_name', help='reference name')
-    parser.add_argument('--num_cores', action='store', dest='num_cores', help='number of cores to use in multiprocessing', default=8, type=int)
+    parser.add_argument('--reference_cache_dir', action='store', dest='reference_cache_dir', help='directory of reference outputs keyed by reference file hash', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--num_cores', action='store', dest='num_cores', help='number of inputs processed in parallel; at most 3 are used (two samples and the reference)', default=3, type=int)
     results = parser.parse_args()
-    
-    # Process both samples
-    process_sample_rename(results.sample1_gtf, results.sample1_name, results.num_cores)
-    process_sample_rename(results.sample2_gtf, results.sample2_name, results.num_cores)
-    # Process reference
-    process_reference_rename(results.reference_gtf, results.reference_name, results.num_cores)
+
+    # both samples and the reference run concurrently in one pool
+    tasks = [(process_sample_rename, (results.sample1_gtf, results.sample1_name)),
+             (process_sample_rename, (results.sample2_gtf, results.sample2_name)),
+             (process_reference_rename, (results.reference_gtf, results.reference_name, results.reference_cache_dir))]
+    with multiprocessing.Pool(processes=max(1, min(results.num_cores, len(tasks)))) as pool:
+        jobs = [pool.apply_async(function, args) for function, args in tasks]
+        for job in jobs:
+            job.get()
 
 #%%
     
@@ -14,13 +14,13 @@ import os, re, sys, subprocess, timeit, glob, copy
 # import shutil
 # import distutils.spawn
 import itertools
-import bisect
+import multiprocessing
 import argparse
 import math
 import numpy as np
-from collections import defaultdict, Counter, namedtuple
+from collections import defaultdict, Counter, namedtuple, deque
 from collections.abc import Iterable
-from csv import DictWriter, DictReader
+import csv
 
 utilitiesPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "utilities")
 sys.path.insert(0, utilitiesPath)
@@ -53,18 +53,46 @@ except ImportError:
 #     sys.path.append('/Users/gloriasheynkman/Documents/research_drive/bioinfo_tools/cDNA_Cupcake/')
 from cupcake.tofu.compare_junctions import compare_junctions
 from cupcake.io.GFF import collapseGFFReader, write_collapseGFF_format
-GTF2GENEPRED_PROG = "gtfToGenePred"
 utilitiesPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "utilities")
 sys.path.insert(0, utilitiesPath)
-GTF2GENEPRED_PROG = os.path.join(utilitiesPath,"gtfToGenePred")
 GFFREAD_PROG = "gffread"
 
 # importing functions from original sqanti3
-from sqanti3_qc import myQueryTranscripts, genePredReader, myQueryProteins, associationOverlapping
+from sqanti3_qc import genePredReader, myQueryProteins
+from gencode_cache import file_hash
+GTF2GENEPRED_PROG = os.path.join(utilitiesPath, "gtfToGenePred")
+GTF2GENEPRED_ARGS = ['-genePredExt', '-allErrors', '-ignoreGroupsWithoutExons']
+# part of every cached genePred name; bump when the conversion command or its output changes
+GENEPRED_CACHE_VERSION = 'v1'
 
 
 # functions that were modified to run "sqanti protein" (gloria and liz)
 
+def genePred_records(gtf_file, mode, cache_dir, gene_name=False, check=False):
+    """
+    genePred records for a GTF, converted with gtfToGenePred once per (file contents, mode) and cached in cache_dir
+    :param mode: 'exon' or 'cds', the kind of comparison the GTF is used for
+    :param gene_name: use gene_name instead of gene_id as name2 (-geneNameAsName2)
+    :param check: exit if gtfToGenePred fails (otherwise its output is used as is)
+    :return: (genePred file, list of genePredRecord)
+    """
+    name = "{0}.{1}.{2}{3}.{4}.genePred".format(os.path.basename(gtf_file), file_hash(gtf_file)[:16], mode,
+                                                ".gene_name" if gene_name else "", GENEPRED_CACHE_VERSION)
+    genePred_file = os.path.join(cache_dir, name)
+    if os.path.exists(genePred_file):
+        print("{0} already exists. Using it.".format(genePred_file), file=sys.stdout)
+        return genePred_file, list(genePredReader(genePred_file))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # convert under a temporary name so a concurrent run never reads a partial file
+    tmp_file = "{0}.{1}.tmp".format(genePred_file, os.getpid())
+    cmd = [GTF2GENEPRED_PROG, gtf_file, tmp_file] + GTF2GENEPRED_ARGS + (['-geneNameAsName2'] if gene_name else [])
+    if subprocess.call(cmd) != 0 and check:
+        print("ERROR running cmd: {0}".format(" ".join(cmd)), file=sys.stderr)
+        sys.exit(-1)
+    os.replace(tmp_file, genePred_file)
+    return genePred_file, list(genePredReader(genePred_file))
+
 def reference_parser(args, genome_chroms):
     """
     Read the reference GTF file
@@ -74,18 +102,11 @@ def reference_parser(args, genome_chroms):
     """
     global referenceFiles
 
-    referenceFiles = os.path.join(args.dir, "refAnnotation_" + args.output_prefix + ".genePred")
     print("**** Parsing Reference Transcriptome....", file=sys.stdout)
 
-    # don't check for exisitng reference file, because need to create a new one for exon and cds centric runs
-    # if os.path.exists(referenceFiles):
-    #     print("{0} already exists. Using it.".format(referenceFiles), file=sys.stdout)
-    # else:
     ## gtf to genePred
-    if not args.genename:
-        subprocess.call([GTF2GENEPRED_PROG, args.annotation, referenceFiles, '-genePredExt', '-allErrors', '-ignoreGroupsWithoutExons'])
-    else:
-        subprocess.call([GTF2GENEPRED_PROG, args.annotation, referenceFiles, '-genePredExt', '-allErrors', '-ignoreGroupsWithoutExons', '-geneNameAsName2'])
+    # the cache is keyed by file hash and mode, so exon and cds centric runs never share a genePred
+    referenceFiles, references = genePred_records(args.annotation, args.mode, args.genepred_cache, gene_name=bool(args.genename))
 
     ## parse reference annotation
     # 1. ignore all miRNAs (< 200 bp)
@@ -104,7 +125,7 @@ def reference_parser(args, genome_chroms):
     ## need this for later computation of 5' and 3' overhangs for protein classification
     refDict = {}
 
-    for r in genePredReader(referenceFiles):
+    for r in references:
         refDict[r.id] = r
         if r.length < args.min_ref_len and not args.is_fusion: continue # ignore miRNAs
         if r.exonCount == 1:
@@ -129,23 +150,89 @@ def reference_parser(args, genome_chroms):
         if len(diff) > 0:
             print("WARNING: ref annotation contains chromosomes not in genome: {0}\n".format(",".join(diff)), file=sys.stderr)
 
-    # convert the content of junctions_by_chr to sorted list
+    # convert the content of junctions_by_chr to sorted arrays
     for k in junctions_by_chr:
-        junctions_by_chr[k]['donors'] = list(junctions_by_chr[k]['donors'])
-        junctions_by_chr[k]['donors'].sort()
-        junctions_by_chr[k]['acceptors'] = list(junctions_by_chr[k]['acceptors'])
-        junctions_by_chr[k]['acceptors'].sort()
-        junctions_by_chr[k]['da_pairs'] = list(junctions_by_chr[k]['da_pairs'])
-        junctions_by_chr[k]['da_pairs'].sort()
+        junctions_by_chr[k] = junction_arrays(**junctions_by_chr[k])
 
     return dict(refs_1exon_by_chr), dict(refs_exons_by_chr), dict(junctions_by_chr), dict(junctions_by_gene), dict(known_5_3_by_gene), refDict
 
 
-class myProteinTranscripts(myQueryTranscripts):
+def pack_junctions(pairs):
+    """
+    Pack (donor, acceptor) pairs into one int64 each (donor in the high 32 bits), so that
+    sorting the packed values sorts the pairs the same way as tuples
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    return (pairs[:, 0] << 32) | pairs[:, 1]
+
+
+def junction_arrays(donors, acceptors, da_pairs):
+    """
+    Sorted int64 arrays of one chromosome's reference donors, acceptors and packed (donor, acceptor) pairs
+    """
+    return {'donors': np.unique(np.fromiter(donors, dtype=np.int64, count=len(donors))),
+            'acceptors': np.unique(np.fromiter(acceptors, dtype=np.int64, count=len(acceptors))),
+            'da_pairs': np.unique(pack_junctions(list(da_pairs)))}
+
+
+def sorted_contains(sorted_values, queries):
+    """
+    Boolean array: is each query in the sorted array sorted_values
+    """
+    idx = np.searchsorted(sorted_values, queries)
+    found = idx < len(sorted_values)
+    found[found] = sorted_values[idx[found]] == queries[found]
+    return found
+
+
+def known_donors(chrom_junctions, donors):
+    return sorted_contains(chrom_junctions['donors'], np.asarray(donors, dtype=np.int64))
+
+
+def known_acceptors(chrom_junctions, acceptors):
+    return sorted_contains(chrom_junctions['acceptors'], np.asarray(acceptors, dtype=np.int64))
+
+
+def next_pairs(chrom_junctions, starts, ends):
+    """
+    For each (start, end), the first reference pair sorting at or after it (as with bisect_left on pair tuples)
+    :return: (donors, acceptors, found) arrays; donor/acceptor are -1 where there is no such pair
+    """
+    da_pairs = chrom_junctions['da_pairs']
+    idx = np.searchsorted(da_pairs, pack_junctions(np.column_stack((starts, ends))))
+    found = idx < len(da_pairs)
+    packed = np.full(len(idx), -1, dtype=np.int64)
+    packed[found] = da_pairs[idx[found]]
+    donors = np.where(found, packed >> 32, -1)
+    acceptors = np.where(found, packed & 0xFFFFFFFF, -1)
+    return donors, acceptors, found
+
+
+class myProteinTranscripts(object):
+    """
+    Classification result of one isoform.
+
+    Carries the same fields as sqanti3_qc.myQueryTranscripts plus the protein-specific ones
+    (ref_obj, num_junc_after_stop, overhangs), but stores them in __slots__ instead of a
+    per-instance __dict__, which keeps the per-isoform footprint small on large datasets.
+    """
+    __slots__ = ('id', 'tss_diff', 'tts_diff', 'tss_gene_diff', 'tts_gene_diff',
+                 'genes', 'AS_genes', 'transcripts', 'num_exons', 'length', 'str_class',
+                 'chrom', 'strand', 'subtype', 'RT_switching', 'canonical',
+                 'min_samp_cov', 'min_cov', 'min_cov_pos', 'sd', 'proteinID',
+                 'ORFlen', 'ORFseq', 'CDS_start', 'CDS_end', 'coding',
+                 'CDS_genomic_start', 'CDS_genomic_end', 'is_NMD', 'FL', 'FL_dict',
+                 'nIndels', 'nIndelsJunc', 'isoExp', 'geneExp', 'refLen', 'refExons',
+                 'refStart', 'refEnd', 'q_splicesite_hit', 'q_exon_overlap', 'FSM_class',
+                 'bite', 'percAdownTTS', 'seqAdownTTS', 'dist_cage', 'within_cage',
+                 'pos_cage_peak', 'dist_polya_site', 'within_polya_site',
+                 'polyA_motif', 'polyA_dist',
+                 'ref_obj', 'num_junc_after_stop', 'overhangs')
+
     def __init__(self, id, tss_diff, tts_diff, num_exons, length, str_class, subtype=None,
                  genes=None, transcripts=None, chrom=None, strand=None, bite ="NA",
                  RT_switching ="????", canonical="NA", min_cov ="NA",
-                 min_cov_pos ="NA", min_samp_cov="NA", sd ="NA", FL ="NA", FL_dict={},
+                 min_cov_pos ="NA", min_samp_cov="NA", sd ="NA", FL ="NA", FL_dict=None,
                  nIndels ="NA", nIndelsJunc ="NA", proteinID=None,
                  ORFlen="NA", CDS_start="NA", CDS_end="NA",
                  CDS_genomic_start="NA", CDS_genomic_end="NA", 
@@ -157,97 +244,131 @@ class myProteinTranscripts(myQueryTranscripts):
                  q_splicesite_hit = 0,
                  q_exon_overlap = 0,
                  FSM_class = None, percAdownTTS = None, seqAdownTTS=None,
-                 dist_cage='NA', within_cage='NA',
+                 dist_cage='NA', within_cage='NA', pos_cage_peak='NA',
                  dist_polya_site='NA', within_polya_site='NA',
                  polyA_motif='NA', polyA_dist='NA', ref_obj=None):
 
-        super().__init__(id, tss_diff=tss_diff,
-                         tts_diff=tts_diff,
-                         num_exons=num_exons,
-                         length=length,
-                         str_class=str_class,
-                         subtype=subtype,
-                 genes=genes, transcripts=transcripts, chrom=chrom, strand=strand, bite=bite,
-                 RT_switching=RT_switching, canonical=canonical, min_cov=min_cov,
-                 min_cov_pos=min_cov_pos, min_samp_cov=min_samp_cov, sd=sd, FL=FL, FL_dict=FL_dict,
-                 nIndels=nIndels, nIndelsJunc=nIndelsJunc , proteinID=proteinID,
-                 ORFlen=ORFlen, CDS_start=CDS_start, CDS_end=CDS_end,
-                 CDS_genomic_start=CDS_genomic_start, CDS_genomic_end=CDS_genomic_end,
-                 ORFseq=ORFseq, is_NMD=is_NMD,
-                 isoExp=isoExp, geneExp=geneExp, coding=coding,
-                 refLen=refLen, refExons=refExons,
-                 refStart=refStart, refEnd=refEnd,
-                 q_splicesite_hit=q_splicesite_hit,
-                 q_exon_overlap=q_exon_overlap,
-                 FSM_class=FSM_class, percAdownTTS=percAdownTTS, seqAdownTTS=seqAdownTTS,
-                 #dist_cage=dist_cage, within_cage=within_cage, #removed to test
-                 #dist_polya_site=dist_polya_site, within_polya_site=within_polya_site, #removed to test
-                 polyA_motif=polyA_motif, polyA_dist=polyA_dist)
-
-        self.ref_obj = ref_obj
-        self.num_junc_after_stop = None
+        self.id = id
+        self.tss_diff = tss_diff   # distance to TSS of best matching ref
+        self.tts_diff = tts_diff   # distance to TTS of best matching ref
+        self.tss_gene_diff = 'NA'  # min distance to TSS of all genes matching the ref
+        self.tts_gene_diff = 'NA'  # min distance to TTS of all genes matching the ref
+        self.genes = genes if genes is not None else []
+        self.AS_genes = set()      # ref genes that are hit on the opposite strand
+        self.transcripts = transcripts if transcripts is not None else []
+        self.num_exons = num_exons
+        self.length = length
+        self.str_class = str_class # structural classification of the isoform
+        self.chrom = chrom
+        self.strand = strand
+        self.subtype = subtype
+        self.RT_switching = RT_switching
+        self.canonical = canonical
+        self.min_samp_cov = min_samp_cov
+        self.min_cov = min_cov
+        self.min_cov_pos = min_cov_pos
+        self.sd = sd
+        self.proteinID = proteinID
+        self.ORFlen = ORFlen
+        self.ORFseq = ORFseq
+        self.CDS_start = CDS_start
+        self.CDS_end = CDS_end
+        self.coding = coding
+        self.CDS_genomic_start = CDS_genomic_start # 1-based genomic coordinate of CDS start - strand aware
+        self.CDS_genomic_end = CDS_genomic_end     # 1-based genomic coordinate of CDS end - strand aware
+        self.is_NMD = is_NMD
+        self.FL = FL               # count (int) for single sample
+        self.FL_dict = FL_dict if FL_dict is not None else {}  # dict of sample -> FL count
+        self.nIndels = nIndels
+        self.nIndelsJunc = nIndelsJunc
+        self.isoExp = isoExp
+        self.geneExp = geneExp
+        self.refLen = refLen
+        self.refExons = refExons
+        self.refStart = refStart
+        self.refEnd = refEnd
+        self.q_splicesite_hit = q_splicesite_hit
+        self.q_exon_overlap = q_exon_overlap
+        self.FSM_class = FSM_class
+        self.bite = bite
+        self.percAdownTTS = percAdownTTS
+        self.seqAdownTTS = seqAdownTTS
         self.dist_cage = dist_cage
         self.within_cage = within_cage
+        self.pos_cage_peak = pos_cage_peak
         self.dist_polya_site = dist_polya_site
         self.within_polya_site = within_polya_site
+        self.polyA_motif = polyA_motif
+        self.polyA_dist = polyA_dist
+        self.ref_obj = ref_obj
+        self.num_junc_after_stop = None
+        self.overhangs = (None, None)  # (5', 3') overhang against transcripts[0], see perfect_subset_overhangs
+
+    def get_total_diff(self):
+        return abs(self.tss_diff)+abs(self.tts_diff)
 
     def modify(self, ref_transcript, ref_gene, tss_diff, tts_diff, refLen, refExons, ref):
-        super().modify(ref_transcript=ref_transcript,
-                         ref_gene=ref_gene,
-                         tss_diff=tss_diff,
-                         tts_diff=tts_diff,
-                         refLen=refLen,
-                         refExons=refExons)
+        self.transcripts = [ref_transcript]
+        self.genes = [ref_gene]
+        self.tss_diff = tss_diff
+        self.tts_diff = tts_diff
+        self.refLen = refLen
+        self.refExons = refExons
         self.ref_obj = ref
 
-    def __str__(self):
-        return "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (self.chrom, self.strand,
-                                                                                                                                                           str(self.length), str(self.num_exons),
-                                                                                                                                                           str(self.str_class), "_".join(set(self.genes)),
-                                                                                                                                                           self.id, str(self.refLen), str(self.refExons),
-                                                                                                                                                           str(self.tss_diff), str(self.tts_diff),
-                                                                                                                                                           self.subtype, self.RT_switching,
-                                                                                                                                                           self.canonical, str(self.min_samp_cov),
-                                                                                                                                                           str(self.min_cov), str(self.min_cov_pos),
-                                                                                                                                                           str(self.sd), str(self.FL), str(self.nIndels),
-                                                                                                                                                           str(self.nIndelsJunc), self.bite, str(self.isoExp),
-                                                                                                                                                           str(self.geneExp), str(self.ratioExp()),
-                                                                                                                                                           self.FSM_class, self.coding, str(self.ORFlen),
-                                                                                                                                                           str(self.CDSlen()), str(self.CDS_start), str(self.CDS_end),
-                                                                                                                                                           str(self.CDS_genomic_start), str(self.CDS_genomic_end), str(self.is_NMD),
-                                                                                                                                                           str(self.percAdownTTS),
-                                                                                                                                                           str(self.seqAdownTTS),
-                                                                                                                                                           str(self.dist_cage),
-                                                                                                                                                           str(self.within_cage),str(self.pos_cage_peak),
-                                                                                                                                                           str(self.dist_polya_site),
-                                                                                                                                                           str(self.within_polya_site),
-                                                                                                                                                           str(self.polyA_motif),
-                                                                                                                                                           str(self.polyA_dist))
+    def ratioExp(self):
+        if self.geneExp == 0 or self.geneExp == "NA":
+            return "NA"
+        else:
+            return float(self.isoExp)/float(self.geneExp)
 
+    def CDSlen(self):
+        if self.coding == "coding":
+            return str(int(self.CDS_end) - int(self.CDS_start) + 1)
+        else:
+            return "NA"
 
+    def as_row(self):
+        """
+        Values of the SQANTI classification columns, in output order
+        """
+        return (self.chrom, self.strand, self.length, self.num_exons,
+                self.str_class, "_".join(set(self.genes)),
+                self.id, self.refLen, self.refExons,
+                self.tss_diff, self.tts_diff,
+                self.subtype, self.RT_switching,
+                self.canonical, self.min_samp_cov,
+                self.min_cov, self.min_cov_pos,
+                self.sd, self.FL, self.nIndels,
+                self.nIndelsJunc, self.bite, self.isoExp,
+                self.geneExp, self.ratioExp(),
+                self.FSM_class, self.coding, self.ORFlen,
+                self.CDSlen(), self.CDS_start, self.CDS_end,
+                self.CDS_genomic_start, self.CDS_genomic_end, self.is_NMD,
+                self.percAdownTTS, self.seqAdownTTS,
+                self.dist_cage, self.within_cage, self.pos_cage_peak,
+                self.dist_polya_site, self.within_polya_site,
+                self.polyA_motif, self.polyA_dist)
+
+    def __str__(self):
+        return "\t".join(map(str, self.as_row()))
 
 
 def protein_isoforms_parser(args):
     """
     Parse input isoforms (GTF) to dict (chr --> sorted list)
     """
-    queryFile = os.path.splitext(args.corrGTF)[0] +".genePred"
-
     print("**** Parsing Isoforms....", file=sys.stderr)
 
     # gtf to genePred
-    cmd = GTF2GENEPRED_PROG + " {0} {1} -genePredExt -allErrors -ignoreGroupsWithoutExons".format(\
-        args.corrGTF, queryFile)
-    if subprocess.check_call(cmd, shell=True)!=0:
-        print("ERROR running cmd: {0}".format(cmd), file=sys.stderr)
-        sys.exit(-1)
+    _, queries = genePred_records(args.corrGTF, args.mode, args.genepred_cache, check=True)
 
     isoforms_list = defaultdict(lambda: []) # chr --> list to be sorted later
 
     # FOR PROTEINS only
     # to compute 5' and 3' overhang for protein classification, need to retrieve the genePred object later
     queryDict = {}
-    for r in genePredReader(queryFile):
+    for r in queries:
         isoforms_list[r.chrom].append(r)
         queryDict[r.id] = r
     for k in isoforms_list:
@@ -263,7 +384,7 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
     :param trec: id record (genePredRecord) to be compared against reference
     :param genome_dict: dict of genome (chrom --> SeqRecord)
     :param nPolyA: window size to look for polyA
-    :return: myQueryTranscripts object that indicates the best reference hit
+    :return: myProteinTranscripts object that indicates the best reference hit
     """
     def calc_overlap(s1, e1, s2, e2):
         if s1=='NA' or s2=='NA': return 0
@@ -653,14 +774,16 @@ def transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends
 def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, junctions_by_gene, start_ends_by_gene):
     """
     At this point: definitely not FSM or ISM, see if it is NIC, NNC, or fusion
-    :return isoforms_hit: updated isoforms hit (myQueryTranscripts object)
+    :return isoforms_hit: updated isoforms hit (myProteinTranscripts object)
     """
+    chrom_junctions = junctions_by_chr[trec.chrom]
+
     def has_intron_retention():
-        for e in trec.exons:
-            m = bisect.bisect_left(junctions_by_chr[trec.chrom]['da_pairs'], (e.start, e.end))
-            if m < len(junctions_by_chr[trec.chrom]['da_pairs']) and e.start <= junctions_by_chr[trec.chrom]['da_pairs'][m][0] < junctions_by_chr[trec.chrom]['da_pairs'][m][1] < e.end:
-                return True
-        return False
+        # an exon retains an intron if the first reference junction sorting after it lies inside it
+        starts = np.array([e.start for e in trec.exons], dtype=np.int64)
+        ends = np.array([e.end for e in trec.exons], dtype=np.int64)
+        donors, acceptors, found = next_pairs(chrom_junctions, starts, ends)
+        return bool(np.any(found & (starts <= donors) & (donors < acceptors) & (acceptors < ends)))
 
     ref_genes = list(set(isoforms_hit.genes))
 
@@ -677,11 +800,10 @@ def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, junctions_by_g
         ref_gene_junctions = junctions_by_gene[ref_genes[0]]
         # 1. check if all donors/acceptor sites are known (regardless of which ref gene it came from)
         # 2. check if this query isoform uses a subset of the junctions from the single ref hit
-        all_junctions_known = True
-        all_junctions_in_hit_ref = True
-        for d,a in trec.junctions:
-            all_junctions_known = all_junctions_known and (d in junctions_by_chr[trec.chrom]['donors']) and (a in junctions_by_chr[trec.chrom]['acceptors'])
-            all_junctions_in_hit_ref = all_junctions_in_hit_ref and ((d,a) in ref_gene_junctions)
+        query_donors = [d for d, a in trec.junctions]
+        query_acceptors = [a for d, a in trec.junctions]
+        all_junctions_known = bool(np.all(known_donors(chrom_junctions, query_donors) & known_acceptors(chrom_junctions, query_acceptors)))
+        all_junctions_in_hit_ref = all(junc in ref_gene_junctions for junc in trec.junctions)
         if all_junctions_known:
             isoforms_hit.str_class="novel_in_catalog"
             if all_junctions_in_hit_ref:
@@ -712,7 +834,47 @@ def novelIsoformsKnownGenes(isoforms_hit, trec, junctions_by_chr, junctions_by_g
     return isoforms_hit
 
 
-def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene, start_ends_by_gene, genome_dict, indelsJunc, orfDict):
+def associationOverlapping(isoforms_hit, trec, junctions_by_chr):
+    """
+    At this point: definitely not FSM, ISM, NIC or NNC. In order of preference the isoform is
+    antisense (on the opposite strand of a known gene), genic (overlaps a same strand gene),
+    genic_intron (within a reference intron) or intergenic.
+    Same logic as sqanti3_qc.associationOverlapping, using the array junction index.
+    :return isoforms_hit: updated isoforms hit (myProteinTranscripts object)
+    """
+    isoforms_hit.str_class = "intergenic"
+    isoforms_hit.transcripts = ["novel"]
+    isoforms_hit.subtype = "mono-exon" if trec.exonCount==1 else "multi-exon"
+
+    if len(isoforms_hit.genes) == 0:
+        # completely no overlap with any genes on the same strand
+        if len(isoforms_hit.AS_genes) == 0 and trec.chrom in junctions_by_chr:
+            # need to check if it is intergenic or genic intron
+            # first reference pair at or after (txStart, txEnd), checked as sqanti3_qc does
+            donors, acceptors, found = next_pairs(junctions_by_chr[trec.chrom], [trec.txStart], [trec.txEnd])
+            if found[0] and donors[0] <= trec.txStart <= acceptors[0]:
+                isoforms_hit.str_class = "genic_intron"
+        else:
+            # hits one or more genes on the opposite strand, or its chromosome has no reference
+            # junctions (as in sqanti3_qc, these are antisense with no genes)
+            isoforms_hit.str_class = "antisense"
+            isoforms_hit.genes = ["novelGene_{g}_AS".format(g=g) for g in isoforms_hit.AS_genes]
+    else:
+        # overlaps with one or more genes on the same strand
+        isoforms_hit.str_class = "genic"
+
+    return isoforms_hit
+
+
+# mode --> inputs used by classify_chromosome, set by register_classification before any worker is forked
+classification_state = {}
+
+
+def register_classification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene, start_ends_by_gene, genome_dict, orfDict, refDict=None):
+    """
+    Keep the inputs of a classification run (keyed by args.mode) where classify_chromosome can find them.
+    The reference trees cannot be pickled, so a pool must be forked after this call to inherit them (copy-on-write).
+    """
     # if args.is_fusion: # read GFF to get fusion components
     #     # ex: PBfusion.1.1 --> (1-based start, 1-based end) of where the fusion component is w.r.t to entire fusion
     #     fusion_components = get_fusion_component(args.isoforms)
@@ -758,8 +920,6 @@ def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_b
     # else:
     #     phyloP_reader = None
 
-    # running classification
-    print("**** Performing Classification of Isoforms....", file=sys.stdout)
 
 
     # accepted_canonical_sites = list(args.sites.split(","))
@@ -773,24 +933,31 @@ def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_b
     # fout_junc = DictWriter(handle_junc, fieldnames=fields_junc_cur, delimiter='\t')
     # fout_junc.writeheader()
 
-    isoforms_info = {}
-    novel_gene_index = 1
+    classification_state[args.mode] = dict(args=args, isoforms_by_chr=isoforms_by_chr, refs_1exon_by_chr=refs_1exon_by_chr,
+                                           refs_exons_by_chr=refs_exons_by_chr, junctions_by_chr=junctions_by_chr,
+                                           junctions_by_gene=junctions_by_gene, start_ends_by_gene=start_ends_by_gene,
+                                           genome_dict=genome_dict, orfDict=orfDict, refDict=refDict)
 
-    for chrom,records in isoforms_by_chr.items():
-        for rec in records:
-            # Find best reference hit
-            isoform_hit = transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends_by_gene, rec, genome_dict, nPolyA=args.window)
 
-            if isoform_hit.str_class in ("anyKnownJunction", "anyKnownSpliceSite"):
-                # not FSM or ISM --> see if it is NIC, NNC, or fusion
-                isoform_hit = novelIsoformsKnownGenes(isoform_hit, rec, junctions_by_chr, junctions_by_gene, start_ends_by_gene)
-            elif isoform_hit.str_class in ("", "geneOverlap"):
-                # possibly NNC, genic, genic intron, anti-sense, or intergenic
-                isoform_hit = associationOverlapping(isoform_hit, rec, junctions_by_chr)
+def iter_classified_chromosomes(args, pool=None):
+    """
+    Classify the isoforms registered for args.mode, one chromosome at a time
+    :param pool: optional process pool forked after register_classification; at most args.cpus chromosomes
+                 are submitted ahead of the one being consumed
+    :return: generator of (chrom, list of (isoform id, myProteinTranscripts)) in input order
+    """
+    # running classification
+    print("**** Performing Classification of Isoforms....", file=sys.stdout)
 
-            # # write out junction information
-            # write_junctionInfo(rec, junctions_by_chr, accepted_canonical_sites, indelsJunc, genome_dict, fout_junc, covInf=SJcovInfo, covNames=SJcovNames, phyloP_reader=phyloP_reader)
+    isoforms_by_chr = classification_state[args.mode]['isoforms_by_chr']
+    chroms = list(isoforms_by_chr)
+    tasks = [(args.mode, chrom) for chrom in chroms]
+    hits_by_chr = imap_bounded(pool, classify_chromosome, tasks, args.cpus) if pool is not None else map(classify_chromosome, tasks)
 
+    # novel gene ids are numbered in input order, so they are assigned here rather than in the workers
+    novel_gene_index = 1
+    for chrom, hits in zip(chroms, hits_by_chr):
+        for isoform_hit in hits:
             if isoform_hit.str_class in ("intergenic", "genic_intron"):
                 # Liz: I don't find it necessary to cluster these novel genes. They should already be always non-overlapping.
                 if args.novel_gene_prefix is not None:  # used by splits to not have redundant novelGene IDs
@@ -799,124 +966,173 @@ def isoformClassification(args, isoforms_by_chr, refs_1exon_by_chr, refs_exons_b
                     isoform_hit.genes = ['novelGene_' + str(novel_gene_index)]
                 isoform_hit.transcripts = ['novel']
                 novel_gene_index += 1
+        yield chrom, [(rec.id, isoform_hit) for rec, isoform_hit in zip(isoforms_by_chr[chrom], hits)]
+    del classification_state[args.mode]
+
+
+def imap_bounded(pool, func, tasks, window):
+    """
+    Ordered pool.imap that keeps at most window tasks submitted but not yet consumed,
+    so finished results do not pile up in the parent while it is busy with another stream
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
 
-            # # look at Cage Peak info (if available)
-            # if cage_peak_obj is not None:
-            #     if rec.strand == '+':
-            #         within_cage, dist_cage , pos_cage_peak = cage_peak_obj.find(rec.chrom, rec.strand, rec.txStart)
-            #     else:
-            #         within_cage, dist_cage , pos_cage_peak = cage_peak_obj.find(rec.chrom, rec.strand, rec.txEnd)
-            #     isoform_hit.within_cage = within_cage
-            #     isoform_hit.dist_cage = dist_cage
-            #     isoform_hit.pos_cage_peak = pos_cage_peak
-
-            # # look at PolyA Peak info (if available)
-            # if polya_peak_obj is not None:
-            #     if rec.strand == '+':
-            #         within_polya_site, dist_polya_site = polya_peak_obj.find(rec.chrom, rec.strand, rec.txStart)
-            #     else:
-            #         within_polya_site, dist_polya_site = polya_peak_obj.find(rec.chrom, rec.strand, rec.txEnd)
-            #     isoform_hit.within_polya_site = within_polya_site
-            #     isoform_hit.dist_polya_site = dist_polya_site
-
-            # # polyA motif finding: look within 50 bp upstream of 3' end for the highest ranking polyA motif signal (user provided)
-            # if polyA_motif_list is not None:
-            #     if rec.strand == '+':
-            #         polyA_motif, polyA_dist = find_polyA_motif(str(genome_dict[rec.chrom][rec.txEnd-50:rec.txEnd].seq), polyA_motif_list)
-            #     else:
-            #         polyA_motif, polyA_dist = find_polyA_motif(str(genome_dict[rec.chrom][rec.txStart:rec.txStart+50].reverse_complement().seq), polyA_motif_list)
-            #     isoform_hit.polyA_motif = polyA_motif
-            #     isoform_hit.polyA_dist = polyA_dist
-
-            # Fill in ORF/coding info and NMD detection
-            if orfDict:
-                if args.is_fusion:
-                    #pdb.set_trace()
-                    # fusion - special case handling, need to see which part of the ORF this segment falls on
-                    fusion_gene = 'PBfusion.' + str(seqid_fusion.match(rec.id).group(1))
-                    rec_component_start, rec_component_end = fusion_components[rec.id]
-                    rec_len = rec_component_end - rec_component_start + 1
-                    if fusion_gene in orfDict:
-                        orf_start, orf_end = orfDict[fusion_gene].cds_start, orfDict[fusion_gene].cds_end
-                        if orf_start <= rec_component_start < orf_end:
-                            isoform_hit.CDS_start = 1
-                            isoform_hit.CDS_end = min(rec_len, orf_end - rec_component_start + 1)
-                            isoform_hit.ORFlen = (isoform_hit.CDS_end - isoform_hit.CDS_start)/3
-                            _s = (rec_component_start-orf_start)//3
-                            _e = min(int(_s+isoform_hit.ORFlen), len(orfDict[fusion_gene].orf_seq))
-                            isoform_hit.ORFseq = orfDict[fusion_gene].orf_seq[_s:_e]
-                            isoform_hit.coding = "coding"
-                        elif rec_component_start <= orf_start < rec_component_end:
-                            isoform_hit.CDS_start = orf_start - rec_component_start
-                            if orf_end >= rec_component_end:
-                                isoform_hit.CDS_end = rec_component_end - rec_component_start + 1
-                            else:
-                                isoform_hit.CDS_end = orf_end - rec_component_start + 1
-                            isoform_hit.ORFlen = (isoform_hit.CDS_end - isoform_hit.CDS_start) / 3
-                            _e = min(int(isoform_hit.ORFlen), len(orfDict[fusion_gene].orf_seq))
-                            isoform_hit.ORFseq = orfDict[fusion_gene].orf_seq[:_e]
-                            isoform_hit.coding = "coding"
-                elif rec.id in orfDict:  # this will never be true for fusion, so the above code seg runs instead
+def classify_chromosome(task):
+    """
+    Classify all isoforms of one chromosome against the reference registered for a mode
+    :param task: (mode, chrom)
+    :return: list of myProteinTranscripts, in the order of isoforms_by_chr[chrom]
+    """
+    mode, chrom = task
+    state = classification_state[mode]
+    hits = []
+    for rec in state['isoforms_by_chr'][chrom]:
+        isoform_hit = classify_isoform(state['args'], rec, state['refs_1exon_by_chr'], state['refs_exons_by_chr'],
+                                       state['junctions_by_chr'], state['junctions_by_gene'], state['start_ends_by_gene'],
+                                       state['genome_dict'], state['orfDict'])
+        if state['refDict'] is not None:
+            isoform_hit.overhangs = perfect_subset_overhangs(rec, isoform_hit, state['refDict'])
+        hits.append(isoform_hit)
+    return hits
+
+
+def classify_isoform(args, rec, refs_1exon_by_chr, refs_exons_by_chr, junctions_by_chr, junctions_by_gene, start_ends_by_gene, genome_dict, orfDict):
+    """
+    Find the best reference hit for one isoform and fill in its ORF and NMD information
+    :return: myProteinTranscripts object (novel gene ids are assigned later by iter_classified_chromosomes)
+    """
+    # Find best reference hit
+    isoform_hit = transcriptsKnownSpliceSites(refs_1exon_by_chr, refs_exons_by_chr, start_ends_by_gene, rec, genome_dict, nPolyA=args.window)
+
+    if isoform_hit.str_class in ("anyKnownJunction", "anyKnownSpliceSite"):
+        # not FSM or ISM --> see if it is NIC, NNC, or fusion
+        isoform_hit = novelIsoformsKnownGenes(isoform_hit, rec, junctions_by_chr, junctions_by_gene, start_ends_by_gene)
+    elif isoform_hit.str_class in ("", "geneOverlap"):
+        # possibly NNC, genic, genic intron, anti-sense, or intergenic
+        isoform_hit = associationOverlapping(isoform_hit, rec, junctions_by_chr)
+
+    # # write out junction information
+    # write_junctionInfo(rec, junctions_by_chr, accepted_canonical_sites, indelsJunc, genome_dict, fout_junc, covInf=SJcovInfo, covNames=SJcovNames, phyloP_reader=phyloP_reader)
+
+    # # look at Cage Peak info (if available)
+    # if cage_peak_obj is not None:
+    #     if rec.strand == '+':
+    #         within_cage, dist_cage , pos_cage_peak = cage_peak_obj.find(rec.chrom, rec.strand, rec.txStart)
+    #     else:
+    #         within_cage, dist_cage , pos_cage_peak = cage_peak_obj.find(rec.chrom, rec.strand, rec.txEnd)
+    #     isoform_hit.within_cage = within_cage
+    #     isoform_hit.dist_cage = dist_cage
+    #     isoform_hit.pos_cage_peak = pos_cage_peak
+
+    # # look at PolyA Peak info (if available)
+    # if polya_peak_obj is not None:
+    #     if rec.strand == '+':
+    #         within_polya_site, dist_polya_site = polya_peak_obj.find(rec.chrom, rec.strand, rec.txStart)
+    #     else:
+    #         within_polya_site, dist_polya_site = polya_peak_obj.find(rec.chrom, rec.strand, rec.txEnd)
+    #     isoform_hit.within_polya_site = within_polya_site
+    #     isoform_hit.dist_polya_site = dist_polya_site
+
+    # # polyA motif finding: look within 50 bp upstream of 3' end for the highest ranking polyA motif signal (user provided)
+    # if polyA_motif_list is not None:
+    #     if rec.strand == '+':
+    #         polyA_motif, polyA_dist = find_polyA_motif(str(genome_dict[rec.chrom][rec.txEnd-50:rec.txEnd].seq), polyA_motif_list)
+    #     else:
+    #         polyA_motif, polyA_dist = find_polyA_motif(str(genome_dict[rec.chrom][rec.txStart:rec.txStart+50].reverse_complement().seq), polyA_motif_list)
+    #     isoform_hit.polyA_motif = polyA_motif
+    #     isoform_hit.polyA_dist = polyA_dist
+
+    # Fill in ORF/coding info and NMD detection
+    if orfDict:
+        if args.is_fusion:
+            #pdb.set_trace()
+            # fusion - special case handling, need to see which part of the ORF this segment falls on
+            fusion_gene = 'PBfusion.' + str(seqid_fusion.match(rec.id).group(1))
+            rec_component_start, rec_component_end = fusion_components[rec.id]
+            rec_len = rec_component_end - rec_component_start + 1
+            if fusion_gene in orfDict:
+                orf_start, orf_end = orfDict[fusion_gene].cds_start, orfDict[fusion_gene].cds_end
+                if orf_start <= rec_component_start < orf_end:
+                    isoform_hit.CDS_start = 1
+                    isoform_hit.CDS_end = min(rec_len, orf_end - rec_component_start + 1)
+                    isoform_hit.ORFlen = (isoform_hit.CDS_end - isoform_hit.CDS_start)/3
+                    _s = (rec_component_start-orf_start)//3
+                    _e = min(int(_s+isoform_hit.ORFlen), len(orfDict[fusion_gene].orf_seq))
+                    isoform_hit.ORFseq = orfDict[fusion_gene].orf_seq[_s:_e]
                     isoform_hit.coding = "coding"
-                    isoform_hit.ORFlen = orfDict[rec.id].orf_length
-                    isoform_hit.CDS_start = orfDict[rec.id].cds_start  # 1-based start
-                    isoform_hit.CDS_end = orfDict[rec.id].cds_end      # 1-based end
-                    isoform_hit.ORFseq  = orfDict[rec.id].orf_seq
-
-            if isoform_hit.coding == "coding":
-                m = {} # transcript coord (0-based) --> genomic coord (0-based)
-                if rec.strand == '+':
-                    i = 0
-                    for exon in rec.exons:
-                        for c in range(exon.start, exon.end):
-                            m[i] = c
-                            i += 1
-                else: # - strand
-                    i = 0
-                    for exon in rec.exons:
-                        for c in range(exon.start, exon.end):
-                            m[rec.length-i-1] = c
-                            i += 1
-
-                isoform_hit.CDS_genomic_start = m[isoform_hit.CDS_start-1] + 1  # make it 1-based
-                # NOTE: if using --orf_input, it is possible to see discrepancy between the exon structure
-                # provided by GFF and the input ORF. For now, just shorten it
-                isoform_hit.CDS_genomic_end = m[min(isoform_hit.CDS_end-1, max(m))] + 1    # make it 1-based
-                #orfDict[rec.id].cds_genomic_start = m[orfDict[rec.id].cds_start-1] + 1  # make it 1-based
-                #orfDict[rec.id].cds_genomic_end   = m[orfDict[rec.id].cds_end-1] + 1    # make it 1-based
-
-
-            if isoform_hit.CDS_genomic_end!='NA':
-                # NMD detection
-                # if + strand, see if CDS stop is before the last junction
-                if len(rec.junctions) > 0:
-                    if rec.strand == '+':
-                        dist_to_last_junc = isoform_hit.CDS_genomic_end - rec.junctions[-1][0]
-                    else: # - strand
-                        dist_to_last_junc = rec.junctions[0][1] - isoform_hit.CDS_genomic_end
-                    isoform_hit.is_NMD = "TRUE" if dist_to_last_junc < 0 else "FALSE"
-                    # can change dist_to_last_junct (above) to < 50, to match gencode nmd definition
-
-            # find number of junctions downstream of stop codon
-            # added as an ad hoc attribute of isoform_hit
-            if isoform_hit.CDS_genomic_end != 'NA':
-                num_junc_after_stop_codon = 0
-                if rec.strand == '+':
-                    for donor_coord, accept_coord in rec.junctions:
-                        if donor_coord > isoform_hit.CDS_genomic_end:
-                            num_junc_after_stop_codon += 1
-                else: # - strand
-                    for donor_coord, accept_coord in rec.junctions:
-                        if accept_coord < isoform_hit.CDS_genomic_end:
-                            num_junc_after_stop_codon += 1
-                isoform_hit.num_junc_after_stop = num_junc_after_stop_codon
-
-            isoforms_info[rec.id] = isoform_hit
-            # fout_class.writerow(isoform_hit.as_dict())
-
-    # handle_class.close()
-    # handle_junc.close()
-    return isoforms_info
+                elif rec_component_start <= orf_start < rec_component_end:
+                    isoform_hit.CDS_start = orf_start - rec_component_start
+                    if orf_end >= rec_component_end:
+                        isoform_hit.CDS_end = rec_component_end - rec_component_start + 1
+                    else:
+                        isoform_hit.CDS_end = orf_end - rec_component_start + 1
+                    isoform_hit.ORFlen = (isoform_hit.CDS_end - isoform_hit.CDS_start) / 3
+                    _e = min(int(isoform_hit.ORFlen), len(orfDict[fusion_gene].orf_seq))
+                    isoform_hit.ORFseq = orfDict[fusion_gene].orf_seq[:_e]
+                    isoform_hit.coding = "coding"
+        elif rec.id in orfDict:  # this will never be true for fusion, so the above code seg runs instead
+            isoform_hit.coding = "coding"
+            isoform_hit.ORFlen = orfDict[rec.id].orf_length
+            isoform_hit.CDS_start = orfDict[rec.id].cds_start  # 1-based start
+            isoform_hit.CDS_end = orfDict[rec.id].cds_end      # 1-based end
+            isoform_hit.ORFseq  = orfDict[rec.id].orf_seq
+
+    if isoform_hit.coding == "coding":
+        m = {} # transcript coord (0-based) --> genomic coord (0-based)
+        if rec.strand == '+':
+            i = 0
+            for exon in rec.exons:
+                for c in range(exon.start, exon.end):
+                    m[i] = c
+                    i += 1
+        else: # - strand
+            i = 0
+            for exon in rec.exons:
+                for c in range(exon.start, exon.end):
+                    m[rec.length-i-1] = c
+                    i += 1
+
+        isoform_hit.CDS_genomic_start = m[isoform_hit.CDS_start-1] + 1  # make it 1-based
+        # NOTE: if using --orf_input, it is possible to see discrepancy between the exon structure
+        # provided by GFF and the input ORF. For now, just shorten it
+        isoform_hit.CDS_genomic_end = m[min(isoform_hit.CDS_end-1, max(m))] + 1    # make it 1-based
+        #orfDict[rec.id].cds_genomic_start = m[orfDict[rec.id].cds_start-1] + 1  # make it 1-based
+        #orfDict[rec.id].cds_genomic_end   = m[orfDict[rec.id].cds_end-1] + 1    # make it 1-based
+
+
+    if isoform_hit.CDS_genomic_end!='NA':
+        # NMD detection
+        # if + strand, see if CDS stop is before the last junction
+        if len(rec.junctions) > 0:
+            if rec.strand == '+':
+                dist_to_last_junc = isoform_hit.CDS_genomic_end - rec.junctions[-1][0]
+            else: # - strand
+                dist_to_last_junc = rec.junctions[0][1] - isoform_hit.CDS_genomic_end
+            isoform_hit.is_NMD = "TRUE" if dist_to_last_junc < 0 else "FALSE"
+            # can change dist_to_last_junct (above) to < 50, to match gencode nmd definition
+
+    # find number of junctions downstream of stop codon
+    # added as an ad hoc attribute of isoform_hit
+    if isoform_hit.CDS_genomic_end != 'NA':
+        num_junc_after_stop_codon = 0
+        if rec.strand == '+':
+            for donor_coord, accept_coord in rec.junctions:
+                if donor_coord > isoform_hit.CDS_genomic_end:
+                    num_junc_after_stop_codon += 1
+        else: # - strand
+            for donor_coord, accept_coord in rec.junctions:
+                if accept_coord < isoform_hit.CDS_genomic_end:
+                    num_junc_after_stop_codon += 1
+        isoform_hit.num_junc_after_stop = num_junc_after_stop_codon
+
+    return isoform_hit
 
 
 def read_in_custom_orf_calls_into_orfDict(orf_file):
@@ -951,11 +1167,29 @@ def read_in_custom_orf_calls_into_orfDict(orf_file):
 MatchIndexTuple = namedtuple('MatchIndexTuple', ['query_idx', 'ref_idx'])
 
 
+def splice_site_index(r):
+    """
+    Exon index of each splice site of a (reference) record, built once and kept on the record
+    :return: (exon end --> first exon index, exon start --> last exon index)
+    """
+    index = getattr(r, 'splice_site_index', None)
+    if index is None:
+        ends = {}
+        starts = {}
+        for idx, exon in enumerate(r.segments):
+            ends.setdefault(exon.end, idx)
+            starts[exon.start] = idx
+        index = r.splice_site_index = (ends, starts)
+    return index
+
+
 def find_indices_for_exons_with_upstream_most_common_splicsite(r1, r2):
+    # first query exon whose end is also a ref exon end
+    ref_ends, _ = splice_site_index(r2)
     for query_idx, qexon in enumerate(r1.segments):
-        for ref_idx, rexon in enumerate(r2.segments):
-            if rexon.end == qexon.end:
-                return MatchIndexTuple(query_idx=query_idx, ref_idx=ref_idx)
+        ref_idx = ref_ends.get(qexon.end)
+        if ref_idx is not None:
+            return MatchIndexTuple(query_idx=query_idx, ref_idx=ref_idx)
     return MatchIndexTuple(query_idx=None, ref_idx=None)
 
 
@@ -984,12 +1218,16 @@ def determine_extent_of_downstream_overhang(r1, r2):
 
 def find_indices_for_exons_with_downstream_most_common_splicsite(r1, r2):
     # r2 is the reference so we prioritze by search for the most 3' of r2 that can be matched by a r1 3' end
-    for ref_idx in range(len(r2.segments) - 1, -1, -1):
-        for query_idx in range(len(r1.segments) - 1, -1, -1):
-            # the acceptor site (if + strand) matches
-            # the donor site (if - strand) matces
-            if r2.segments[ref_idx].start == r1.segments[query_idx].start:
-                return MatchIndexTuple(query_idx=query_idx, ref_idx=ref_idx)
+    # (ties on the ref exon go to the most 3' query exon)
+    _, ref_starts = splice_site_index(r2)
+    match = None
+    for query_idx in range(len(r1.segments) - 1, -1, -1):
+        # the acceptor site (if + strand) matches
+        # the donor site (if - strand) matces
+        ref_idx = ref_starts.get(r1.segments[query_idx].start)
+        if ref_idx is not None and (match is None or ref_idx > match.ref_idx):
+            match = MatchIndexTuple(query_idx=query_idx, ref_idx=ref_idx)
+    return match
 
 
 def get_perfect_subset_status(r1, r2):
@@ -1015,6 +1253,17 @@ def get_perfect_subset_status(r1, r2):
 
     return five_prime_overhang, three_prime_overhang
 
+
+def perfect_subset_overhangs(query, isoform_hit, refDict):
+    """
+    Overhangs of a query isoform against the first transcript of its hit (only the first is used for overhang calc)
+    :return: (5_overhang_diff, 3_overhang_diff), or (None, None) if the hit is not a reference transcript
+    """
+    match_id = isoform_hit.transcripts[0]
+    if match_id in refDict:
+        return get_perfect_subset_status(query, refDict[match_id])
+    return None, None
+
 ### end ###
 
 
@@ -1022,6 +1271,61 @@ def get_perfect_subset_status(r1, r2):
 
 
 
+def write_protein_classification(output_filename, transcript_hits, protein_hits, orfDict, protein_chroms):
+    """
+    Write one row per cds isoform as soon as its chromosome has been classified in both runs,
+    so only a chromosome's worth of classification results is held at a time
+    :param transcript_hits: iter_classified_chromosomes output of the exon-based run
+    :param protein_hits: iter_classified_chromosomes output of the cds-based run
+    :param protein_chroms: chromosomes with cds isoforms; exon results of other chromosomes are dropped on arrival
+    """
+    FIELDNAMES = ['pb', 'tx_cat', 'pr_splice_cat', 'tx_subcat', 'pr_splice_subcat',
+                  'tx_tss_diff', 'tx_tts_diff', 'tx_tss_gene_diff', 'tx_tts_gene_diff',
+                  'pr_nterm_diff', 'pr_cterm_diff', 'pr_nterm_gene_diff', 'pr_cterm_gene_diff',
+                  'tx_transcripts', 'pr_transcripts',
+                  'tx_gene', 'pr_gene',
+                  'tx_num_exons', 'pr_num_exons',
+                  'is_nmd',
+                  'num_junc_after_stop_codon', 'num_nt_after_stop_codon',
+                  'tx_5hang', 'tx_3hang',
+                  'pr_nhang', 'pr_chang']
+    transcripts_by_chr = {}  # chrom --> {pb: transcript object}, exon chromosomes read ahead of the cds ones
+    with open(output_filename, 'w') as f:
+        fout = csv.writer(f, delimiter='\t')
+        fout.writerow(FIELDNAMES)
+        for chrom, hits in protein_hits:
+            if chrom not in transcripts_by_chr:
+                for tx_chrom, tx_hits in transcript_hits:
+                    if tx_chrom in protein_chroms:
+                        transcripts_by_chr[tx_chrom] = dict(tx_hits)
+                    if tx_chrom == chrom:
+                        break
+            transcripts = transcripts_by_chr.pop(chrom, {})
+            rows = []
+            for pb, pr in hits:
+                # pr is the protein object
+                tx = transcripts[pb] # get transcript object
+
+                # perfect subset info for transcript (exon) and protein (cds), computed during classification
+                tx_5hang, tx_3hang = tx.overhangs
+                pr_5hang, pr_3hang = pr.overhangs
+
+                # one value per FIELDNAMES entry, in the same order
+                rows.append((pb,
+                             tx.str_class, pr.str_class,
+                             tx.subtype, pr.subtype,
+                             tx.tss_diff, tx.tts_diff, tx.tss_gene_diff, tx.tts_gene_diff,
+                             pr.tss_diff, pr.tts_diff, pr.tss_gene_diff, pr.tts_gene_diff,
+                             ','.join(tx.transcripts), ','.join(pr.transcripts),
+                             ','.join(tx.genes), ','.join(pr.genes),
+                             tx.num_exons, pr.num_exons,
+                             tx.is_NMD * 1,
+                             tx.num_junc_after_stop, orfDict[pb].num_3utr_nt,
+                             tx_5hang, tx_3hang,
+                             pr_5hang, pr_3hang))
+            fout.writerows(rows)
+
+
 ###############################
 ##### start of sqanti run #####
 ###############################
@@ -1038,6 +1342,8 @@ if __name__ == "__main__":
     parser.add_argument("cds_annotation_gtf", help="Annotation GTF, for CDS")
     parser.add_argument("-d", "--output_dir", default="output", help="Output directory (default: output)")
     parser.add_argument("-p", "--output_prefix", default="out", help="Output prefix (default: out")
+    parser.add_argument("--cpus", type=int, default=1, help="Number of chromosomes to classify in parallel (default: 1)")
+    parser.add_argument("--genepred_cache", default=None, help="Directory of converted genePred files, reused across runs (default: <output_dir>/genepred_cache)")
 
 
     args = parser.parse_args()
@@ -1045,6 +1351,7 @@ if __name__ == "__main__":
     output_dir = args.output_dir
     output_prefix = args.output_prefix
     output_filename = os.path.join(output_dir, output_prefix+'.sqanti_protein_classification.tsv')
+    genepred_cache = args.genepred_cache or os.path.join(output_dir, 'genepred_cache')
 
     if os.path.exists(output_dir):
         if not os.path.isdir(output_dir):
@@ -1053,7 +1360,7 @@ if __name__ == "__main__":
     else:
         os.makedirs(output_dir)
 
-    SQANTIArgs = namedtuple('SQANTIArgs', 'isoform annotation dir output_prefix genename min_ref_len is_fusion corrGTF orf_tsv coverage window novel_gene_prefix')
+    SQANTIArgs = namedtuple('SQANTIArgs', 'isoform annotation dir output_prefix genename min_ref_len is_fusion corrGTF orf_tsv coverage window novel_gene_prefix cpus mode genepred_cache')
     # NOTE - liz - i need to stick with these names since they are originally in sqanti input
     # for now, not changing into *_filename
     cds_isoform_gff = args.isoform_gff
@@ -1070,7 +1377,10 @@ if __name__ == "__main__":
                       is_fusion=False,
                       coverage=None,
                       window=None,
-                      novel_gene_prefix=None)
+                      novel_gene_prefix=None,
+                      cpus=args.cpus,
+                      mode='exon',
+                      genepred_cache=genepred_cache)
 
 
     #### process exon-based comparisons ####
@@ -1085,24 +1395,24 @@ if __name__ == "__main__":
     ## read in orf calls from cpat (from lrp pipeline) into sqanti orfDict format
     orfDict = read_in_custom_orf_calls_into_orfDict(sqanti_args.orf_tsv)
 
-    ## transcript isoform classification
-    isoforms_info = isoformClassification(sqanti_args,
-                                          isoforms_by_chr,
-                                          refs_1exon_by_chr,
-                                          refs_exons_by_chr,
-                                          junctions_by_chr,
-                                          junctions_by_gene,
-                                          start_ends_by_gene,
-                                          orfDict=orfDict,
-                                          genome_dict=None,
-                                          indelsJunc=None)
+    ## transcript isoform classification (run below, together with the cds classification)
+    register_classification(sqanti_args,
+                            isoforms_by_chr,
+                            refs_1exon_by_chr,
+                            refs_exons_by_chr,
+                            junctions_by_chr,
+                            junctions_by_gene,
+                            start_ends_by_gene,
+                            genome_dict=None,
+                            orfDict=orfDict,
+                            refDict=refDict)
 
 
     #### process cds-based comparisons ####
 
 
     # updated named tuple to point to cds files (genocode, pacbio)
-    ProteinArgs = namedtuple('ProteinArgs', 'isoform annotation dir output_prefix genename min_ref_len is_fusion corrGTF orf_tsv coverage window novel_gene_prefix')
+    ProteinArgs = namedtuple('ProteinArgs', 'isoform annotation dir output_prefix genename min_ref_len is_fusion corrGTF orf_tsv coverage window novel_gene_prefix cpus mode genepred_cache')
     # NOTE - liz - i need to stick with these names since they are originally in sqanti input
     cds_isoform_gff = args.cds_isoform_gff #os.path.abspath(ddir + 'jurkat_cds_chr22.gff')
     cds_annotation_gtf = args.cds_annotation_gtf #os.path.abspath(ddir + 'gencode_cds_chr22.gtf')
@@ -1117,7 +1427,10 @@ if __name__ == "__main__":
                                is_fusion=False,
                                coverage=None,
                                window=None,
-                               novel_gene_prefix=None)
+                               novel_gene_prefix=None,
+                               cpus=args.cpus,
+                               mode='cds',
+                               genepred_cache=genepred_cache)
 
     ## parse reference transcripts(GTF) to dicts
     protein_refs_1exon_by_chr, protein_refs_exons_by_chr, protein_junctions_by_chr, \
@@ -1129,82 +1442,23 @@ if __name__ == "__main__":
 
     # isoform classification
     # note - orfDict is input, but results not in use for cds compare
-    isoforms_info_cds = isoformClassification(protein_args,
-                                              protein_isoforms_by_chr,
-                                              protein_refs_1exon_by_chr,
-                                              protein_refs_exons_by_chr,
-                                              protein_junctions_by_chr,
-                                              protein_junctions_by_gene,
-                                              protein_start_ends_by_gene,
-                                              genome_dict=None,
-                                              indelsJunc=None,
-                                              orfDict=None)
-
-    #### write out results
-    #### note - need to get "perfect subset" data while write-out
-    f = open(output_filename, 'w')
-    FIELDNAMES = ['pb', 'tx_cat', 'pr_splice_cat', 'tx_subcat', 'pr_splice_subcat',
-                  'tx_tss_diff', 'tx_tts_diff', 'tx_tss_gene_diff', 'tx_tts_gene_diff',
-                  'pr_nterm_diff', 'pr_cterm_diff', 'pr_nterm_gene_diff', 'pr_cterm_gene_diff',
-                  'tx_transcripts', 'pr_transcripts',
-                  'tx_gene', 'pr_gene',
-                  'tx_num_exons', 'pr_num_exons',
-                  'is_nmd',
-                  'num_junc_after_stop_codon', 'num_nt_after_stop_codon',
-                  'tx_5hang', 'tx_3hang',
-                  'pr_nhang', 'pr_chang']
-    writer = DictWriter(f, delimiter='\t', fieldnames=FIELDNAMES)
-    writer.writeheader()
-    for pb, pr in isoforms_info_cds.items():
-        # pr is the protein object
-        tx = isoforms_info[pb] # get transcript object
-
-        # get perfect subset info for transcript (exon)
-        transcript_match_id = tx.transcripts[0] #only get first transcript for overhang calc
-        if transcript_match_id in refDict and pb in queryDict:
-            ref = refDict[transcript_match_id]
-            query = queryDict[pb]
-            tx_5hang, tx_3hang = get_perfect_subset_status(query, ref)
-        else:
-            tx_5hang, tx_3hang = None, None
-
-        # get perfect subset info for protein (cds)
-        protein_match_id = pr.transcripts[0] #only get first transcript for overhang calc
-        if protein_match_id in protein_refDict_cds and pb in queryDict_cds:
-            pr_ref = protein_refDict_cds[protein_match_id]
-            pr_query = queryDict_cds[pb]
-            pr_5hang, pr_3hang = get_perfect_subset_status(pr_query, pr_ref)
-        else:
-            pr_5hang, pr_3hang = None, None
-
-        info = {'pb': pb,
-                'tx_cat': tx.str_class,
-                'pr_splice_cat': pr.str_class,
-                'tx_subcat': tx.subtype,
-                'pr_splice_subcat': pr.subtype,
-                'tx_tss_diff': tx.tss_diff,
-                'tx_tts_diff': tx.tts_diff,
-                'tx_tss_gene_diff': tx.tss_gene_diff,
-                'tx_tts_gene_diff': tx.tts_gene_diff,
-                'pr_nterm_diff': pr.tss_diff,
-                'pr_cterm_diff': pr.tts_diff,
-                'pr_nterm_gene_diff': pr.tss_gene_diff,
-                'pr_cterm_gene_diff': pr.tts_gene_diff,
-                'tx_transcripts': ','.join(tx.transcripts),
-                'pr_transcripts': ','.join(pr.transcripts),
-                'tx_gene': ','.join(tx.genes),
-                'pr_gene': ','.join(pr.genes),
-                'tx_num_exons': tx.num_exons,
-                'pr_num_exons': pr.num_exons,
-                'is_nmd': tx.is_NMD * 1,
-                'num_junc_after_stop_codon': tx.num_junc_after_stop,
-                'num_nt_after_stop_codon': orfDict[pb].num_3utr_nt,
-                'tx_5hang': tx_5hang,
-                'tx_3hang': tx_3hang,
-                'pr_nhang': pr_5hang,
-                'pr_chang': pr_3hang
-                }
-        writer.writerow(info)
-    f.close()
+    register_classification(protein_args,
+                            protein_isoforms_by_chr,
+                            protein_refs_1exon_by_chr,
+                            protein_refs_exons_by_chr,
+                            protein_junctions_by_chr,
+                            protein_junctions_by_gene,
+                            protein_start_ends_by_gene,
+                            genome_dict=None,
+                            orfDict=None,
+                            refDict=protein_refDict_cds)
+
+    #### classify and write out results, one chromosome at a time
+    if args.cpus > 1:
+        with multiprocessing.get_context('fork').Pool(args.cpus) as pool:
+            write_protein_classification(output_filename, iter_classified_chromosomes(sqanti_args, pool),
+                                         iter_classified_chromosomes(protein_args, pool), orfDict, set(protein_isoforms_by_chr))
+    else:
+        write_protein_classification(output_filename, iter_classified_chromosomes(sqanti_args),
+                                     iter_classified_chromosomes(protein_args), orfDict, set(protein_isoforms_by_chr))
     print(f"Output written to: {output_filename}")
-
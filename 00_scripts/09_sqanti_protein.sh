@@ -36,7 +36,8 @@ python 00_scripts/09_sqanti_protein.py \
 08_rename_cds_to_exon/gencode.transcript_exons_only.gtf \
 08_rename_cds_to_exon/gencode.cds_renamed_exon.gtf \
 -d 09_sqanti_protein/ \
--p condition1
+-p condition1 \
+--cpus 8
 
 # condition 2
 python 00_scripts/09_sqanti_protein.py \
@@ -46,7 +47,8 @@ python 00_scripts/09_sqanti_protein.py \
 08_rename_cds_to_exon/gencode.transcript_exons_only.gtf \
 08_rename_cds_to_exon/gencode.cds_renamed_exon.gtf \
 -d 09_sqanti_protein/ \
--p condition2
+-p condition2 \
+--cpus 8
 
 conda deactivate
 module purge
\ No newline at end of file
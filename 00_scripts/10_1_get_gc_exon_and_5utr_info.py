@@ -6,16 +6,38 @@
 
 #%%
 
-import subprocess
 from collections import Counter
-from collections import defaultdict 
 import os
 import pickle
 import argparse
+import numpy as np
+import pandas as pd
+import gencode_cache
+
+def merge_intervals(chroms, starts, ends):
+    """
+    Sort intervals by chromosome (lexicographic) and start, then merge overlapping and
+    book-ended ones in one sweep, as bedtools sort | bedtools merge does.
+    Returns (chroms, starts, ends) of the merged intervals.
+    """
+    codes, names = pd.factorize(np.asarray(chroms, dtype=object), sort=True)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    # offset each chromosome past the previous one so a single running max of the ends sweeps all of them
+    offset = codes.astype(np.int64) * (int(max(ends.max(initial=0), starts.max(initial=0))) + 2)
+    reach = np.maximum.accumulate(ends + offset)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] + offset[1:] > reach[:-1]
+    first = np.flatnonzero(new)
+    merged_ends = np.maximum.reduceat(ends, first) if len(first) else ends[:0]
+    return names[codes[first]], starts[first], merged_ends
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gencode_gtf',action='store',dest='gencode_gtf')
 parser.add_argument('--odir',action='store',dest='odir')
+parser.add_argument('--reference_cache',action='store',dest='reference_cache',default=gencode_cache.DEFAULT_CACHE_DIR)
 args = parser.parse_args()
 
 
@@ -26,66 +48,40 @@ if not os.path.exists(odir):
 
 # prepare files and data structures for later comparison of pacbio 5utr to gencode
 
+# load gencode cds and exon records from the compiled gtf
+gtf = gencode_cache.load_gtf(args.gencode_gtf, args.reference_cache, usecols=['seqname', 'feature', 'start', 'end', 'strand', 'gene_name', 'transcript_name'], features=['CDS', 'exon'])
+
 # read in isonames containing a cds (coding)
-pc_isonames = set() # isonames with a cds
-biotypes = []
-for line in open(args.gencode_gtf):
-    if line.startswith('#'): continue
-    wds = line.split('\t')
-    if wds[2] == 'CDS':
-        isoname = wds[8].split('transcript_name "')[1].split('"')[0]
-        pc_isonames.add(isoname)
+pc_isonames = set(gtf.loc[gtf['feature'] == 'CDS', 'transcript_name']) # isonames with a cds
+pc_exons = gtf[(gtf['feature'] == 'exon') & gtf['transcript_name'].isin(pc_isonames)]
 
 # make a bed file with cds isonames
 gencode_cds_bed_fpath = os.path.join(odir,'gencode_exons_for_cds_containing_ensts.bed')
-with open(gencode_cds_bed_fpath, 'w') as ofile: 
-    for line in open(args.gencode_gtf):
-        if line.startswith('#'): continue
-        wds = line.split('\t')
-        if wds[2] == 'exon':
-            isoname = wds[8].split('transcript_name "')[1].split('"')[0]
-            if isoname in pc_isonames:
-                chrom, start, end = wds[0], wds[3], wds[4]
-                ofile.write('\t'.join([chrom, start, end]) + '\n')
+pc_exons[['seqname', 'start', 'end']].to_csv(gencode_cds_bed_fpath, sep='\t', header=False, index=False)
 
 # make gencode merged bed
 # this will be used for determining if 5' end of pacbio transcripts are protruding into intronic regions
-cat_cmd = f'''cat {gencode_cds_bed_fpath} '''
-grep_cmd = '''| bedtools sort | bedtools merge | uniq | grep '^chr' | awk '{print $1 "\t" ($2 - 1) "\t"  $3}' '''
-out_cmd = f'''> {gencode_cds_bed_fpath}_merged.bed'''
-cmd = cat_cmd + grep_cmd + out_cmd
-process = subprocess.run(cmd, shell=True, capture_output=True) 
-
-# load in gc exon coords
-gc_coords = defaultdict(lambda: defaultdict(lambda: [None, None, []])) # genename -> [<strand>, <exon chain string>, <exon coords as ints>]
-# example - GAPDH -> ['+', '50-100_150-200_250-300', [[50, 100], [150, 200], [250, 300]]]
-for line in open(args.gencode_gtf):
-    if line.startswith('#'): continue
-    wds = line.split('\t')
-    if wds[2] == 'exon':
-        isoname = wds[8].split('transcript_name "')[1].split('"')[0]
-        genename = wds[8].split('gene_name "')[1].split('"')[0]
-        if isoname in pc_isonames:
-            chrom, start, end, strand = wds[0], int(wds[3]), int(wds[4]), wds[6]
-            gc_coords[genename][isoname][0] = strand
-            gc_coords[genename][isoname][2].append([start, end])
+# written as bed (0-based start), chr* sequences only
+merged_chroms, merged_starts, merged_ends = merge_intervals(pc_exons['seqname'], pc_exons['start'], pc_exons['end'])
+keep = np.array([chrom.startswith('chr') for chrom in merged_chroms], dtype=bool)
+merged = pd.DataFrame({'chrom': merged_chroms[keep], 'start': merged_starts[keep] - 1, 'end': merged_ends[keep]})
+merged.to_csv(f'{gencode_cds_bed_fpath}_merged.bed', sep='\t', header=False, index=False)
 
 # make exon chains
-gc_chains = defaultdict(lambda: defaultdict(lambda: [])) # gene -> isoname -> exon chain string
-for gene, iso_dict in gc_coords.items():
-    for isoname, [strand, _, exon_coords] in iso_dict.items():
-        exon_coords = sorted(exon_coords)
-        coord_str = '_'.join([str(s) + '-' + str(e) for s, e in exon_coords])
-        gc_coords[gene][isoname][1] = coord_str
-        gc_chains[gene][isoname] = coord_str
-
+# example - GAPDH, GAPDH-201 -> '50-100_150-200_250-300' (exons sorted by coordinate)
+# genes and isonames are written in the order they first appear in the gtf
+chains = pd.DataFrame({'gene': pd.factorize(pc_exons['gene_name'])[0],
+                       'iso': pd.factorize(pc_exons['transcript_name'])[0],
+                       'start': pc_exons['start'].to_numpy(dtype=np.int64),
+                       'end': pc_exons['end'].to_numpy(dtype=np.int64),
+                       'gene_name': pc_exons['gene_name'].to_numpy(),
+                       'transcript_name': pc_exons['transcript_name'].to_numpy()})
+chains = chains.sort_values(['gene', 'iso', 'start', 'end'], kind='mergesort')
+chains['coords'] = chains['start'].astype(str) + '-' + chains['end'].astype(str)
+gc_chains = chains.groupby(['gene', 'iso'], sort=False).agg(gene_name=('gene_name', 'first'),
+                                                            transcript_name=('transcript_name', 'first'),
+                                                            chain=('coords', '_'.join))
 
 # write out exon chain strings
 with open(os.path.join(odir, 'gc_exon_chain_strings_for_cds_containing_transcripts.tsv'), 'w') as ofile:
-    for gene in gc_chains:
-        for isoname in gc_chains[gene]:
-            chain_string = gc_chains[gene][isoname]
-            ofile.write(f'{gene}\t{isoname}\t{chain_string}\n')
-
-
-
+    ofile.write(''.join(gc_chains['gene_name'] + '\t' + gc_chains['transcript_name'] + '\t' + gc_chains['chain'] + '\n'))
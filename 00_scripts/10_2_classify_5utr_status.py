@@ -6,9 +6,9 @@
 
 from collections import defaultdict
 from collections import Counter
-import re
 import argparse
 import os
+import numpy as np
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gencode_exons_bed',action='store',dest='gencode_exons_bed')
@@ -28,6 +28,18 @@ for line in open(args.gencode_exons_bed):
     start, end = int(start), int(end)
     gc_exons[chrom].append([start, end])
 
+def merge_ranges(ranges):
+    # sorted start/end arrays of non-overlapping ranges covering the same positions as ranges
+    ranges = np.array(sorted(ranges), dtype=np.int64).reshape(-1, 2)
+    starts, ends = ranges[:, 0], ranges[:, 1]
+    reach = np.maximum.accumulate(ends)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1]
+    first = np.flatnonzero(new)
+    return starts[first], np.maximum.reduceat(ends, first)
+
+gc_exon_index = {chrom: merge_ranges(ranges) for chrom, ranges in gc_exons.items()} # chr -> (starts, ends)
+
 ## read in gencode coords
 gc_chains = defaultdict(lambda: []) # gene -> list of exon chains (str)
 for line in open(args.gencode_exons_chain):
@@ -121,21 +133,45 @@ for pb, [gene, chrom, strand, exons, cdss] in pbs.items():
 
 # helper functions
 
-def get_5end_coord_at_pb_junction_match(strand, junc_chain_5utr, gc_chain):
-    # get 5' end of the 5' most exon that mapped to the pb 5utr junction chain
-    if strand == '+':
-        prefix = gc_chain.split(junc_chain_5utr)[0]
-        linked_5end_coord = int(re.split('_|-', prefix)[-2])
-        return linked_5end_coord
-    else: # neg strand
-        prefix = gc_chain.split(junc_chain_5utr)[1]
-        linked_5end_coord = int(re.split('_|-', prefix)[1])
-        return linked_5end_coord
-
-def determine_if_5end_of_junction_chain_is_protruding_or_subset(strand, tss, junc_chain_5utr, gc_chain):
+def parse_exon_chain(exon_chain_str):
+    # '100-150_200-250' -> [(100, 150), (200, 250)]
+    return [tuple(int(c) for c in exon.split('-')) for exon in exon_chain_str.split('_')]
+
+def parse_junction_chain(junc_chain_str):
+    # '150_200-250_300' -> ((150, 200), (250, 300)), the (donor, acceptor) of each junction
+    return tuple(tuple(int(c) for c in junc.split('_')) for junc in junc_chain_str.split('-'))
+
+gc_junction_index = {} # gene -> junction -> list of (gc exons, gc junctions, index of the junction)
+gc_linked_5ends = {} # (gene, pb junctions) -> (min linked 5' end on '+', max linked 5' end on '-'), or None if novel
+
+def get_gene_junction_index(gene):
+    # hashed junction index of all gc chains of a gene, built the first time a pb of the gene needs it
+    if gene not in gc_junction_index:
+        index = defaultdict(lambda: [])
+        for gc_chain in gc_chains[gene]:
+            exons = parse_exon_chain(gc_chain)
+            junctions = tuple((exons[i][1], exons[i + 1][0]) for i in range(len(exons) - 1))
+            for i, junction in enumerate(junctions):
+                index[junction].append((exons, junctions, i))
+        gc_junction_index[gene] = index
+    return gc_junction_index[gene]
+
+def get_linked_5ends(gene, junctions):
+    # 5' end of the 5' most exon linked to the pb 5utr junction chain, over all gc chains of the gene that contain it
+    # (start of the exon before the first junction on '+', end of the exon after the last junction on '-')
+    key = (gene, junctions)
+    if key not in gc_linked_5ends:
+        plus_5ends, minus_5ends = [], []
+        for exons, gc_junctions, i in get_gene_junction_index(gene).get(junctions[0], []):
+            if gc_junctions[i:i + len(junctions)] == junctions:
+                plus_5ends.append(exons[i][0])
+                minus_5ends.append(exons[i + len(junctions)][1])
+        gc_linked_5ends[key] = (min(plus_5ends), max(minus_5ends)) if plus_5ends else None
+    return gc_linked_5ends[key]
+
+def determine_if_5end_of_junction_chain_is_protruding_or_subset(strand, tss, gc_5end):
     # status would be protrudes or is_subset
     # require protruding by 10 or more nt to be a valid protrusion
-    gc_5end = get_5end_coord_at_pb_junction_match(strand, junc_chain_5utr, gc_chain)
     if strand == '+':
         if (tss + 9) < gc_5end:
             return 'protruding'
@@ -147,21 +183,18 @@ def determine_if_5end_of_junction_chain_is_protruding_or_subset(strand, tss, jun
         else:
             return 'subset'
 
-def get_5utr_junc_chain_status(gene, strand, tss, junc_chain_5utr, gc_chains):
+def get_5utr_junc_chain_status(gene, strand, tss, junc_chain_5utr):
     # determine 5'utr category, if 5utr has one or more junctions
-    # first determine if junction chain is known or novel
-    junc_stat = 'novel'
-    tss_stat = ''
-    for gc_chain in gc_chains[gene]:
-        # gc_chain is the junction chain for the whole gc transcript (e.g., '100-150_200-250_300-375')
-        if junc_chain_5utr in gc_chain:
-            tss_stat = determine_if_5end_of_junction_chain_is_protruding_or_subset(strand, tss, junc_chain_5utr, gc_chain)
-            if tss_stat == 'subset':
-                junc_stat = 'perfect_subset'
-            else: # protruding
-                if junc_stat != 'perfect_subset':
-                    junc_stat = 'known_protruding'
-    return junc_stat
+    # the junction chain is known if a gc transcript of the gene contains it (e.g., '150_200-250_300' in
+    # gc exon chain '100-150_200-250_300-375'); it is a subset if any such gc transcript extends at least
+    # as far 5' as the pb tss (within 10 nt), so only the most 5' linked gc end needs to be checked
+    linked_5ends = get_linked_5ends(gene, parse_junction_chain(junc_chain_5utr))
+    if linked_5ends is None:
+        return 'novel'
+    gc_5end = linked_5ends[0] if strand == '+' else linked_5ends[1]
+    if determine_if_5end_of_junction_chain_is_protruding_or_subset(strand, tss, gc_5end) == 'subset':
+        return 'perfect_subset'
+    return 'known_protruding'
 
 def get_exon_status(num_5utr_exons):
     exon_status = 'monoexonic'
@@ -169,39 +202,45 @@ def get_exon_status(num_5utr_exons):
         exon_status = 'multiexonic'
     return exon_status
 
-def get_5utr_mono_exon_status(gene, strand, tss, gc_ranges):
+NO_PROTRUSION_RANGE = 999999999 # chr1 len is 250M
+
+def locate_in_gc_exons(chroms, strands, positions):
+    # for all positions at once, binary search the merged gencode exon ranges of their chromosome
+    # returns (within: position lies in a gc exon range,
+    #          protruding_distance: distance to the nearest range downstream of the position on the '+' strand,
+    #                               upstream on the '-' strand; only meaningful where within is False)
+    chroms = np.asarray(chroms, dtype=object)
+    strands = np.asarray(strands, dtype=object)
+    positions = np.asarray(positions, dtype=np.int64)
+    within = np.zeros(len(positions), dtype=bool)
+    protruding_distance = np.full(len(positions), NO_PROTRUSION_RANGE, dtype=np.int64)
+    for chrom in set(chroms):
+        if chrom not in gc_exon_index:
+            continue
+        starts, ends = gc_exon_index[chrom]
+        rows = np.flatnonzero(chroms == chrom)
+        pos = positions[rows]
+        i = np.searchsorted(starts, pos, side='right') - 1 # last range starting at or before the position
+        prev = np.maximum(i, 0)
+        nxt = np.minimum(i + 1, len(starts) - 1)
+        within[rows] = (i >= 0) & (pos <= ends[prev])
+        downstream = np.where(i + 1 < len(starts), starts[nxt] - pos, NO_PROTRUSION_RANGE)
+        upstream = np.where(i >= 0, pos - ends[prev], NO_PROTRUSION_RANGE)
+        protruding_distance[rows] = np.where(strands[rows] == '+', downstream, upstream)
+    return within, protruding_distance
+
+def get_5utr_mono_exon_status(tss_within, protruding_distance):
     # note that if protrusion is not equal to or greater than 10 nt
     # that the tss is considered to be "within" the gc exons
-    for (start, end) in gc_ranges:
-        if start <= tss <= end:
-            # tss resides within gc exons
-            return 'within'
+    if tss_within:
+        # tss resides within gc exons
+        return 'within'
     # at this point, tss is in intronic region
-    # determine the protruding distance
-    protruding_distance = 999999999 # chr1 len is 250M
-    if strand == '+':
-        for (start, end) in gc_ranges:
-            if start > tss:
-                cur_dist = start - tss
-                if cur_dist < protruding_distance:
-                    protruding_distance = cur_dist
-    else: # strand == '-'
-        for (start, end) in gc_ranges:
-            if tss > end:
-                cur_dist = tss - end
-                if cur_dist < protruding_distance:
-                    protruding_distance = cur_dist
     if protruding_distance >= 10:
         return 'protruding'
     else:
         return 'within'
 
-def is_pb_nterm_within_gc_exons(pb_start, gc_ranges):
-    for (start, end) in gc_ranges:
-        if start <= pb_start <= end:
-            return True
-    return False
-
 def determine_final_utr_cat(junc_cat):
     if 'protruding' in junc_cat or 'novel' in junc_cat:
         return 'unique'
@@ -209,18 +248,22 @@ def determine_final_utr_cat(junc_cat):
         return 'subset'
 
 
+# locate all pb tss in the gencode exon ranges in one batch
+pb_tss_within, pb_protruding_distance = locate_in_gc_exons([info[1] for info in pb_info.values()],
+                                                           [info[2] for info in pb_info.values()],
+                                                           [info[3] for info in pb_info.values()])
+
 with open(os.path.join(args.odir, 'pb_5utr_categories.tsv'), 'w') as ofile:
     ofile.write('pb\tgene\tnum_5utr_exons\tutr_exon_status\ttss_in_gc_exons\tjunc_cat\tutr_cat\n')
     lens = []
-    for pb, [gene, chrom, strand, tss, nterm, num_5utr_exons, junc_chain_5utr] in pb_info.items():
-        gc_ranges = gc_exons[chrom]
+    for k, (pb, [gene, chrom, strand, tss, nterm, num_5utr_exons, junc_chain_5utr]) in enumerate(pb_info.items()):
         junc_cat = '-'
         exon_status = get_exon_status(num_5utr_exons)
         if exon_status == 'monoexonic':
-            junc_cat = get_5utr_mono_exon_status(gene, strand, tss, gc_ranges)
+            junc_cat = get_5utr_mono_exon_status(pb_tss_within[k], pb_protruding_distance[k])
         else: # exon_status == 'multiexonic':
-            junc_cat = get_5utr_junc_chain_status(gene, strand, tss, junc_chain_5utr, gc_chains)
-        is_tss_within_gc_exons = is_pb_nterm_within_gc_exons(tss, gc_ranges) * 1
+            junc_cat = get_5utr_junc_chain_status(gene, strand, tss, junc_chain_5utr)
+        is_tss_within_gc_exons = int(pb_tss_within[k])
         utr_cat = determine_final_utr_cat(junc_cat)
         odata = [pb, gene, num_5utr_exons, exon_status, is_tss_within_gc_exons, junc_cat, utr_cat]
         ofile.write('\t'.join([str(x) for x in odata]) + '\n')
@@ -1,161 +1,114 @@
 #!/usr/bin/env python3
 #%%
 import pandas as pd 
+import numpy as np
 import argparse
 
-def classify_protein_splice_fsm(row):
-    if row.pr_splice_cat=='full-splice_match' and row.pr_splice_subcat=='multi-exon':
-        ## if nterm and cterm match
-        if row.pr_nterm_diff==0 and row.pr_cterm_diff==0:
-            return 'pFSM,known_nterm_known_splice_known_cterm'
-        ## if nterm and cterm do not match
-        elif (row.pr_nterm_diff!=0 or row.pr_cterm_diff!=0) and row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff==0:
-            return 'pNIC,combo_nterm_cterm'
-        ## nterm is matched, cterm is not matched
-        elif row.pr_nterm_diff==0 and row.pr_cterm_diff!=0:
-            return 'pNNC,known_nterm_known_splice_novel_cterm'
-        ## nterm is not matched, cterm is matched
-        ## all cases below are when row.pr_nterm_gene_diff!=0
-        elif row.pr_nterm_diff!=0 and row.pr_cterm_diff==0:
-            if row.pr_nhang>0:
-                return 'pNNC,novel_nterm_known_splice_known_cterm'
-            elif row.pr_nhang<=0:
-                if row.utr_cat=='subset':
-                    return 'pISM,ntrunc'
-                elif row.utr_cat=='unique':
-                    return 'pNNC,novel_nterm_known_splice_known_cterm'
-        ## nterm is not matched, cterm is not matched
-        elif row.pr_nterm_diff!=0 and row.pr_cterm_diff!=0:
-            if row.pr_nterm_gene_diff==0:
-                return 'pNNC,known_nterm_known_splice_novel_cterm'
-            elif row.pr_nterm_gene_diff!=0:
-                if row.utr_cat=='subset':
-                    return 'pISM,ntrunc'
-                elif row.utr_cat=='unique':
-                    if row.pr_cterm_gene_diff==0:
-                        return 'pNNC,novel_nterm_known_splice_known_cterm'
-                    elif row.pr_cterm_gene_diff!=0:
-                        return 'pNNC,novel_nterm_known_splice_novel_cterm'
-        else:
-            return 'orphan_fsm'
-    return ''
+def protein_classification_table(df):
+    """
+    Decision table of the protein classification, one (family condition, rules, default) entry per family.
 
-def classify_protein_splice_ism(row):
-    if row.pr_splice_cat=='incomplete-splice_match' and 'mono-exon' not in row.pr_splice_subcat:
-        ### cases where nterm matches but cterm differs
-        if row.pr_nterm_diff==0 and row.pr_cterm_diff!=0:
-            if row.pr_cterm_gene_diff!=0:
-                return 'pNNC,known_nterm_known_splice_novel_cterm'
-            elif row.pr_cterm_gene_diff==0:
-                return 'pNIC,combo_nterm_cterm'
-        ### cases where nterm and cterm match (retained intron causes unique splicing)
-        elif row.pr_nterm_diff==0 and row.pr_cterm_diff==0:
-            return 'pNIC,known_nterm_combo_splice_known_cterm'
-        ### cases where nterm differs, but cterm matches
-        elif row.pr_nterm_diff!=0 and row.pr_cterm_diff==0:
-            if row.pr_nterm_gene_diff==0:
-                return 'pNIC,combo_nterm_cterm'
-            else: # row.pr_nterm_gene_diff!=0
-                if row.pr_nhang<=0:
-                    # determine if nterm is valid novel nterm or an ntrunc
-                    if row.utr_cat=='subset':
-                        return 'pISM,ntrunc'
-                    elif row.utr_cat=='unique':
-                        return 'pNNC,novel_nterm_known_splice_known_cterm'
-                    else:
-                        raise Exception('Invalid utr_cat - needs to be subset or unique')
-                elif row.pr_nhang>0:
-                    return 'pNNC,novel_nterm_known_splice_known_cterm'
-        ### cases where nterm and cterm diff
-        elif row.pr_nterm_diff!=0 and row.pr_cterm_diff!=0:
-            if row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff==0:
-                return 'pNIC,combo_nterm_cterm'
-            elif row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff!=0:
-                return 'pNNC,known_nterm_known_splice_novel_cterm'
-            elif row.pr_nterm_gene_diff!=0:
-                if row.utr_cat=='subset':
-                    return 'pISM,ntrunc'
-                elif row.utr_cat=='unique':
-                    if row.pr_cterm_gene_diff==0:
-                        return 'pNNC,novel_nterm_known_splice_known_cterm'
-                    elif row.pr_cterm_gene_diff!=0:
-                        return 'pNNC,novel_nterm_known_splice_novel_cterm'
-        else:
-            return 'orphan_ism'
-    return ''
+    Within a family the first rule whose condition holds gives the label, like an if/elif chain, and
+    rows matching no rule get the family default. Rows matching a rule labelled None cannot be classified.
+    Rows matching several families get their labels concatenated.
+    """
+    cat = df['pr_splice_cat']
+    subcat = df['pr_splice_subcat']
+    nterm = df['pr_nterm_diff']
+    cterm = df['pr_cterm_diff']
+    nterm_gene = df['pr_nterm_gene_diff']
+    cterm_gene = df['pr_cterm_gene_diff']
+    nhang = df['pr_nhang']
+    subset = df['utr_cat']=='subset'
+    unique = df['utr_cat']=='unique'
+    multi_exon = subcat=='multi-exon'
+    not_mono_exon = ~subcat.astype(str).str.contains('mono-exon', regex=False)
 
-def classify_protein_splice_nic(row):
-    if row.pr_splice_cat=='novel_in_catalog' and 'mono-exon' not in row.pr_splice_subcat:
-        if row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff==0:
-            return 'pNIC,known_nterm_combo_splice_known_cterm'
-        elif row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff!=0:
-            return 'pNNC,known_nterm_combo_splice_novel_cterm'
-        elif row.pr_nterm_gene_diff!=0:
-            if row.utr_cat=='subset':
-                return 'pISM,ntrunc'
-            elif row.utr_cat=='unique':
-                if row.pr_cterm_gene_diff==0:
-                    return 'pNNC,novel_nterm_combo_splice_known_cterm'
-                else:
-                    return 'pNNC,novel_nterm_combo_splice_novel_cterm'
-        else:
-            return 'orphan_nic'
-    return ''
+    ## nterm / cterm match
+    known_known = (nterm==0) & (cterm==0)
+    known_novel = (nterm==0) & (cterm!=0)
+    novel_known = (nterm!=0) & (cterm==0)
+    novel_novel = (nterm!=0) & (cterm!=0)
+    known_gene_nterm = nterm_gene==0
+    novel_gene_nterm = nterm_gene!=0
 
-def classify_protein_splice_nnc(row):
-    if row.pr_splice_cat=='novel_not_in_catalog':
-        if row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff==0:
-            return 'pNNC,known_nterm_novel_splice_known_cterm'
-        elif row.pr_nterm_gene_diff==0 and row.pr_cterm_gene_diff!=0:
-            return 'pNNC,known_nterm_novel_splice_novel_cterm'
-        elif row.pr_nterm_gene_diff!=0:
-            if row.utr_cat=='subset':
-                return 'pISM,ntrunc' 
-            elif row.utr_cat=='unique':
-                if row.pr_cterm_gene_diff==0:
-                    return 'pNNC,novel_nterm_novel_splice_known_cterm'
-                else:
-                    return 'pNNC,novel_nterm_novel_splice_novel_cterm'
-        else:
-            return 'orphan_nnc'
-    return ''
+    fsm = [
+        (known_known, 'pFSM,known_nterm_known_splice_known_cterm'),
+        (((nterm!=0) | (cterm!=0)) & (nterm_gene==0) & (cterm_gene==0), 'pNIC,combo_nterm_cterm'),
+        (known_novel, 'pNNC,known_nterm_known_splice_novel_cterm'),
+        (novel_known & (nhang>0), 'pNNC,novel_nterm_known_splice_known_cterm'),
+        (novel_known & (nhang<=0) & subset, 'pISM,ntrunc'),
+        (novel_known & (nhang<=0) & unique, 'pNNC,novel_nterm_known_splice_known_cterm'),
+        (novel_known, ''),
+        (novel_novel & known_gene_nterm, 'pNNC,known_nterm_known_splice_novel_cterm'),
+        (novel_novel & novel_gene_nterm & subset, 'pISM,ntrunc'),
+        (novel_novel & novel_gene_nterm & unique & (cterm_gene==0), 'pNNC,novel_nterm_known_splice_known_cterm'),
+        (novel_novel & novel_gene_nterm & unique & (cterm_gene!=0), 'pNNC,novel_nterm_known_splice_novel_cterm'),
+        (novel_novel, ''),
+    ]
+    ism = [
+        (known_novel & (cterm_gene!=0), 'pNNC,known_nterm_known_splice_novel_cterm'),
+        (known_novel & (cterm_gene==0), 'pNIC,combo_nterm_cterm'),
+        (known_novel, ''),
+        (known_known, 'pNIC,known_nterm_combo_splice_known_cterm'),
+        (novel_known & known_gene_nterm, 'pNIC,combo_nterm_cterm'),
+        (novel_known & (nhang<=0) & subset, 'pISM,ntrunc'),
+        (novel_known & (nhang<=0) & unique, 'pNNC,novel_nterm_known_splice_known_cterm'),
+        (novel_known & (nhang<=0), None),  # invalid utr_cat
+        (novel_known & (nhang>0), 'pNNC,novel_nterm_known_splice_known_cterm'),
+        (novel_known, ''),
+        (novel_novel & known_gene_nterm & (cterm_gene==0), 'pNIC,combo_nterm_cterm'),
+        (novel_novel & known_gene_nterm & (cterm_gene!=0), 'pNNC,known_nterm_known_splice_novel_cterm'),
+        (novel_novel & novel_gene_nterm & subset, 'pISM,ntrunc'),
+        (novel_novel & novel_gene_nterm & unique & (cterm_gene==0), 'pNNC,novel_nterm_known_splice_known_cterm'),
+        (novel_novel & novel_gene_nterm & unique & (cterm_gene!=0), 'pNNC,novel_nterm_known_splice_novel_cterm'),
+        (novel_novel, ''),
+    ]
+    nic = [
+        (known_gene_nterm & (cterm_gene==0), 'pNIC,known_nterm_combo_splice_known_cterm'),
+        (known_gene_nterm & (cterm_gene!=0), 'pNNC,known_nterm_combo_splice_novel_cterm'),
+        (novel_gene_nterm & subset, 'pISM,ntrunc'),
+        (novel_gene_nterm & unique & (cterm_gene==0), 'pNNC,novel_nterm_combo_splice_known_cterm'),
+        (novel_gene_nterm & unique, 'pNNC,novel_nterm_combo_splice_novel_cterm'),
+        (novel_gene_nterm, ''),
+    ]
+    nnc = [
+        (known_gene_nterm & (cterm_gene==0), 'pNNC,known_nterm_novel_splice_known_cterm'),
+        (known_gene_nterm & (cterm_gene!=0), 'pNNC,known_nterm_novel_splice_novel_cterm'),
+        (novel_gene_nterm & subset, 'pISM,ntrunc'),
+        (novel_gene_nterm & unique & (cterm_gene==0), 'pNNC,novel_nterm_novel_splice_known_cterm'),
+        (novel_gene_nterm & unique, 'pNNC,novel_nterm_novel_splice_novel_cterm'),
+        (novel_gene_nterm, ''),
+    ]
+    monoexon = [
+        ((cat=='full-splice_match') & known_known, 'pFSM,mono-exon'),
+        (cat=='intergenic', 'intergenic,mono-exon'),
+    ]
+    misc = [(cat==category, f'{category},multi-exon') for category in ['intergenic', 'genic', 'antisense', 'fusion']]
 
-def classify_protein_splice_monoexon(row):
-    if row.pr_splice_subcat=='mono-exon' or row.pr_splice_subcat=='mono-exon_by_intron_retention':
-        if row.pr_splice_cat=='full-splice_match' and row.pr_nterm_diff==0 and row.pr_cterm_diff==0:
-            return 'pFSM,mono-exon'
-        elif row.pr_splice_cat=='intergenic':
-            return 'intergenic,mono-exon'
-        # ignoring previous trunc/altnterm
-        else:
-            return 'orphan_monoexon,mono-exon'
-    return ''
+    return [
+        ((cat=='full-splice_match') & multi_exon, fsm, 'orphan_fsm'),
+        ((cat=='incomplete-splice_match') & not_mono_exon, ism, 'orphan_ism'),
+        ((cat=='novel_in_catalog') & not_mono_exon, nic, 'orphan_nic'),
+        (cat=='novel_not_in_catalog', nnc, 'orphan_nnc'),
+        (subcat.isin(['mono-exon', 'mono-exon_by_intron_retention']), monoexon, 'orphan_monoexon,mono-exon'),
+        (multi_exon, misc, ''),
+    ]
 
-def classify_protein_splice_misc(row):
-    if row.pr_splice_subcat=='multi-exon':
-        if row.pr_splice_cat=='intergenic':
-            return 'intergenic,multi-exon'
-        elif row.pr_splice_cat=='genic':
-            return 'genic,multi-exon'
-        elif row.pr_splice_cat=='antisense':
-            return 'antisense,multi-exon'
-        elif row.pr_splice_cat=='fusion':
-            return 'fusion,multi-exon'
-    return ''
-
-
-def classify_protein(row):
-    fsm_classiciation = classify_protein_splice_fsm(row)
-    ism_classification = classify_protein_splice_ism(row)
-    nic_classification = classify_protein_splice_nic(row)
-    nnc_classification = classify_protein_splice_nnc(row)
-    mono_classification = classify_protein_splice_monoexon(row)
-    misc_classification = classify_protein_splice_misc(row)
-    agg_classification = fsm_classiciation + ism_classification + nic_classification + nnc_classification + mono_classification + misc_classification 
-    return (
-        agg_classification
-    )
-    
+def classify_proteins(df):
+    """
+    Evaluate protein_classification_table over all rows of df, returning the protein_classification column
+    """
+    classification = np.full(len(df), '', dtype=object)
+    for family, rules, default in protein_classification_table(df):
+        labels = np.array([label for _, label in rules] + [default], dtype=object)
+        choice = np.select([condition.to_numpy() for condition, _ in rules], np.arange(len(rules)), default=len(rules))
+        family_labels = np.where(family.to_numpy(), labels[choice], '')
+        unclassified = np.flatnonzero(pd.isna(family_labels))
+        if len(unclassified) > 0:
+            raise Exception(f'Invalid utr_cat - needs to be subset or unique ({len(unclassified)} proteins, first at row {unclassified[0]})')
+        classification = classification + family_labels
+    return pd.Series(classification, index=df.index, dtype=object)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -165,7 +118,7 @@ def main():
     args = parser.parse_args()
 
     protein_classification = pd.read_table(args.sqanti_protein)
-    protein_classification['protein_classification'] = protein_classification.apply(classify_protein, axis = 1)
+    protein_classification['protein_classification'] = classify_proteins(protein_classification)
     cats = protein_classification["protein_classification"].str.split(",", n = 1, expand = True)
     protein_classification['protein_classification_base'] = cats[0]
     protein_classification['protein_classification_subset'] = cats[1]
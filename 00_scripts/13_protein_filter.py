@@ -7,6 +7,7 @@
 
 
 import pandas as pd
+import numpy as np
 import argparse
 from Bio import SeqIO
 parser = argparse.ArgumentParser()
@@ -22,38 +23,49 @@ args = parser.parse_args()
 #%%
 
 
-def determine_if_pb_should_be_filtered(row, min_junc_after_stop_codon):
+# protein classification bases kept when a protein has many junctions after its stop codon
+PCLASS_BASE_TO_KEEP = ['pFSM','pNIC']
+# protein classifications containing any of these are artifacts or noncoding
+PCLASS_FILTER_PATTERN = 'trunc|intergenic|antisense|fusion|orphan|genic'
+
+PSUBCLASS_SHORT = {
+    'known_nterm_novel_splice_known_cterm': 'kn_ns_kc',
+    'known_nterm_known_splice_known_cterm': 'kn_ks_kc',
+    'known_nterm_combo_splice_known_cterm': 'kn_cs_kc',
+    'known_nterm_novel_splice_novel_cterm': 'kn_ns_nc',
+    'known_nterm_combo_splice_novel_cterm': 'kn_cs_nc',
+    'known_nterm_known_splice_novel_cterm': 'kn_ks_nc',
+    'novel_nterm_known_splice_known_cterm': 'nn_ks_kc',
+    'mono-exon': 'mono',
+    'ntrunc': 'ntrunc',
+    'combo_nterm_cterm': 'cnc',
+    'novel_nterm_known_splice_novel_cterm': 'nn_ks_nc',
+    'novel_nterm_novel_splice_known_cterm': 'nn_ns_kc',
+    'novel_nterm_combo_splice_novel_cterm': 'nn_cs_nc',
+    'novel_nterm_combo_splice_known_cterm': 'nn_cs_kc',
+    'novel_nterm_novel_splice_novel_cterm': 'nn_ns_nc',
+    'multi-exon': 'multi',
+    'ctrunc': 'ctrunc',
+}
+
+def determine_if_pb_should_be_filtered(prot, min_junc_after_stop_codon):
     """PB should be filtered if NMD, a truncation, or protein classification
     is not likely protein coding (intergenic, antisense, fusion,...)
 
     Args:
-        row (pandas Series): protein classification row
+        prot (pandas DataFrame): protein classification table
         min_junc_after_stop_codon (int): mininum number of junctions after stop
         codon a protein can have. used in NMD determination
 
     Returns:
-        int: 1 if should be filtered, 0 if should not be filtered
+        pandas Series: 1 if should be filtered, 0 if should not be filtered
     """
     # filter out pbs that are artifacts or noncoding
-    pclass = str(row['protein_classification'])
-    num_junc_after_stop_codon = int(row['num_junc_after_stop_codon'])
-    pclass_base_to_keep = ['pFSM','pNIC']
-    pclass_base = str(row['protein_classification_base'])
-    if pclass_base not in pclass_base_to_keep and num_junc_after_stop_codon > min_junc_after_stop_codon:
-        return 1
-    elif 'trunc' in pclass: 
-        return 1
-    elif 'intergenic' in pclass:
-        return 1
-    elif 'antisense' in pclass:
-        return 1
-    elif 'fusion' in pclass:
-        return 1
-    elif 'orphan' in pclass:
-        return 1
-    elif 'genic' in pclass:
-        return 1
-    return 0
+    num_junc_after_stop_codon = prot['num_junc_after_stop_codon'].astype(int)
+    pclass_base = prot['protein_classification_base'].astype(str)
+    is_nmd = ~pclass_base.isin(PCLASS_BASE_TO_KEEP) & (num_junc_after_stop_codon > min_junc_after_stop_codon)
+    is_artifact = prot['protein_classification'].astype(str).str.contains(PCLASS_FILTER_PATTERN, regex=True)
+    return (is_nmd | is_artifact).astype(int)
 
 def get_short_psubclass_descriptor(psubclass):
     """Generates a short descriptor of the subclass
@@ -68,52 +80,35 @@ def get_short_psubclass_descriptor(psubclass):
         string: short subclass descriptor
     """
     # derive a shorter psubclass for viewing on ucsc browser
-    if psubclass == 'known_nterm_novel_splice_known_cterm':
-        return 'kn_ns_kc'
-    elif psubclass == 'known_nterm_known_splice_known_cterm':
-        return 'kn_ks_kc'
-    elif psubclass == 'known_nterm_combo_splice_known_cterm':
-        return 'kn_cs_kc'
-    elif psubclass == 'known_nterm_novel_splice_novel_cterm':
-        return 'kn_ns_nc'
-    elif psubclass == 'known_nterm_combo_splice_novel_cterm':
-        return 'kn_cs_nc'
-    elif psubclass == 'known_nterm_known_splice_novel_cterm':
-        return 'kn_ks_nc'
-    elif psubclass == 'novel_nterm_known_splice_known_cterm':
-        return 'nn_ks_kc'
-    elif psubclass == 'mono-exon':
-        return 'mono'
-    elif psubclass == 'ntrunc':
-        return 'ntrunc'
-    elif psubclass == 'combo_nterm_cterm':
-        return 'cnc'
-    elif psubclass == 'novel_nterm_known_splice_novel_cterm':
-        return 'nn_ks_nc'
-    elif psubclass == 'novel_nterm_novel_splice_known_cterm':
-        return 'nn_ns_kc'
-    elif psubclass == 'novel_nterm_combo_splice_novel_cterm':
-        return 'nn_cs_nc'
-    elif psubclass == 'novel_nterm_combo_splice_known_cterm':
-        return 'nn_cs_kc'
-    elif psubclass == 'novel_nterm_novel_splice_novel_cterm':
-        return 'nn_ns_nc'
-    elif psubclass == 'multi-exon':
-        return 'multi'
-    elif psubclass == 'ctrunc':
-        return 'ctrunc'
-    else:
-        raise Exception('Invalid psubclass:' + psubclass)
+    if psubclass not in PSUBCLASS_SHORT:
+        raise Exception('Invalid psubclass:' + str(psubclass))
+    return PSUBCLASS_SHORT[psubclass]
+
+def get_short_psubclass_descriptors(psubclass):
+    """Short descriptors for a column of subclasses, looked up once per distinct subclass
+
+    Args:
+        psubclass (pandas Series): protein classification subclasses
+
+    Returns:
+        pandas Series: short subclass descriptors
+    """
+    missing = psubclass.isna()
+    if missing.any():
+        get_short_psubclass_descriptor(psubclass[missing].iloc[0])
+    psubclass = psubclass.astype('category')
+    short = np.array([get_short_psubclass_descriptor(value) for value in psubclass.cat.categories], dtype=object)
+    return pd.Series(short[psubclass.cat.codes.to_numpy()], index=psubclass.index)
 
 prot = pd.read_table(args.protein_classification)
 prot = prot.dropna(subset=['protein_classification'])
-prot['filter_status'] = prot.apply(lambda row: determine_if_pb_should_be_filtered(row, args.min_junctions_after_stop_codon), axis=1)
+prot['filter_status'] = determine_if_pb_should_be_filtered(prot, args.min_junctions_after_stop_codon)
 
 
 prot['pclass'] = prot['protein_classification'].str.split(',').str[0]
 prot['pclass'] = prot['pclass'].fillna('-')
 prot['psubclass'] = prot['protein_classification'].str.split(',').str[1]
-prot['psubclass_short'] = prot['psubclass'].apply(get_short_psubclass_descriptor)
+prot['psubclass_short'] = get_short_psubclass_descriptors(prot['psubclass'])
 
 # output info needed for ucsc track visualization
 prot['orf_calling_confidence']
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+This module splits a FASTA file into several output FASTAs in a single pass
+
+Records are read as raw header/sequence lines (no SeqRecord objects) and each one is routed to
+every output whose ID set contains its identifier. Routed records are re-wrapped at 60 columns,
+so the output matches what Bio.SeqIO.write produces while the input is read once.
+
+Inputs:
+--------------------------------------------------------------
+1. FASTA file
+2. (output path, ID set) pairs
+--------------------------------------------------------------
+
+Output:
+-------------------------------------------------------------
+1. one FASTA per output path
+--------------------------------------------------------------
+"""
+
+# Import Modules
+import argparse
+import logging
+
+LINE_WIDTH = 60
+
+# Define Functions
+def iter_fasta_blocks(fasta_file):
+    """
+    Yield (record id, title line, sequence lines) for each FASTA record, as raw bytes.
+
+    The record id follows Bio.SeqIO: the title up to the first whitespace.
+    """
+    with open(fasta_file, 'rb') as handle:
+        title = None
+        lines = []
+        for line in handle:
+            if line.startswith(b'>'):
+                if title is not None:
+                    yield title.split(None, 1)[0] if title else b'', title, lines
+                title = line[1:].rstrip()
+                lines = []
+            elif title is not None:
+                lines.append(line)
+        if title is not None:
+            yield title.split(None, 1)[0] if title else b'', title, lines
+
+def format_record(title, lines, width=LINE_WIDTH):
+    """
+    Render a record the way Bio.SeqIO.write does: the title, then the sequence wrapped at width
+    """
+    seq = b''.join(line.rstrip() for line in lines).replace(b' ', b'').replace(b'\r', b'')
+    body = b''.join(seq[i:i + width] + b'\n' for i in range(0, len(seq), width))
+    return b'>' + title + b'\n' + body
+
+def partition_fasta(fasta_file, outputs, default=None, key=None):
+    """
+    Route each record of fasta_file to the outputs whose ID set contains it, reading the input once.
+
+    Args:
+        fasta_file (str): input FASTA
+        outputs (list): (output path, set of record ids) pairs
+        default (str, optional): output path for records that are in none of the ID sets
+        key (function, optional): maps a record id (str) to the value looked up in the ID sets
+
+    Returns:
+        list: number of records written to each output, then to default if given
+    """
+    paths = [path for path, _ in outputs] + ([default] if default is not None else [])
+    id_sets = [ids for _, ids in outputs]
+    counts = [0] * len(paths)
+    handles = [open(path, 'wb') for path in paths]
+    try:
+        for record_id, title, lines in iter_fasta_blocks(fasta_file):
+            record_id = record_id.decode()
+            if key is not None:
+                record_id = key(record_id)
+            targets = [i for i, ids in enumerate(id_sets) if record_id in ids]
+            if not targets and default is not None:
+                targets = [len(paths) - 1]
+            if not targets:
+                continue
+            record = format_record(title, lines)
+            for i in targets:
+                handles[i].write(record)
+                counts[i] += 1
+    finally:
+        for handle in handles:
+            handle.close()
+    for path, count in zip(paths, counts):
+        logging.info(f"Wrote {count} records to {path}")
+    return counts
+
+def main():
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Split a FASTA into the records listed in an ID file and the rest')
+    parser.add_argument('--fasta', '-f', action='store', dest='fasta_file', help='Input FASTA file location', required=True)
+    parser.add_argument('--ids', '-i', action='store', dest='id_file', help='File with one record id per line', required=True)
+    parser.add_argument('--output', '-o', action='store', dest='output', help='Output FASTA for listed records', required=True)
+    parser.add_argument('--rest', '-r', action='store', dest='rest', help='Output FASTA for the remaining records', default=None)
+    results = parser.parse_args()
+    with open(results.id_file) as file:
+        ids = set(line.strip() for line in file if line.strip())
+    partition_fasta(results.fasta_file, [(results.output, ids)], default=results.rest)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+This module compiles a GENCODE GTF into a columnar binary cache that is shared by the other modules
+
+The GTF is parsed once. Each column is written as a NumPy array (integers directly, strings as
+integer codes plus a table of unique values) into a directory keyed by the SHA-1 of the GTF file,
+so any module that needs the same annotation loads it with memory-mapped reads instead of re-parsing text.
+
+Inputs:
+--------------------------------------------------------------
+1. Gencode gtf file
+--------------------------------------------------------------
+
+Output:
+-------------------------------------------------------------
+1. <cache_dir>/<gtf name>.<file hash>/ with one .npy file per column
+--------------------------------------------------------------
+"""
+
+# Import Modules
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_DIR = os.path.join('01_reference_tables', 'gencode_cache')
+GTF_COLUMNS = ['seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame']
+INT_COLUMNS = ('start', 'end')
+MANIFEST = 'columns.tsv'
+
+# Define Functions
+def file_hash(filename, block_size=1 << 20):
+    """
+    Return the SHA-1 hex digest of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_path(gtf_file, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Location of the compiled cache for a GTF file, keyed by file name and content hash
+    """
+    name = os.path.basename(gtf_file)
+    return os.path.join(cache_dir, f"{name}.{file_hash(gtf_file)[:16]}")
+
+def parse_gtf(gtf_file):
+    """
+    Parse a GTF file into a DataFrame with the attribute column expanded.
+
+    Follows gtfparse conventions: attributes missing from a row are empty strings and
+    repeated attributes (e.g. tag) are joined with ','.
+    """
+    fixed = [[] for _ in GTF_COLUMNS]
+    attributes = {}  # attribute -> (row indices, values)
+    num_rows = 0
+    with open(gtf_file, 'r') as file:
+        for line in file:
+            if line.startswith('#'):
+                continue
+            wds = line.rstrip('\n').split('\t')
+            if len(wds) < 9:
+                continue
+            for column, value in zip(fixed, wds[:8]):
+                column.append(value)
+            row_attributes = {}
+            for field in wds[8].split(';'):
+                field = field.strip()
+                if not field:
+                    continue
+                key, _, value = field.partition(' ')
+                value = value.strip().strip('"')
+                if key in row_attributes:
+                    row_attributes[key] = row_attributes[key] + ',' + value
+                else:
+                    row_attributes[key] = value
+            for key, value in row_attributes.items():
+                rows, values = attributes.setdefault(key, ([], []))
+                rows.append(num_rows)
+                values.append(value)
+            num_rows += 1
+
+    data = {}
+    for name, column in zip(GTF_COLUMNS, fixed):
+        data[name] = np.array(column, dtype=np.int64) if name in INT_COLUMNS else np.array(column, dtype=object)
+    for key, (rows, values) in attributes.items():
+        column = np.full(num_rows, '', dtype=object)
+        column[rows] = values
+        data[key] = column
+    return pd.DataFrame(data)
+
+def write_cache(df, directory):
+    """
+    Write each column of df as .npy arrays (strings as int32 codes + unique values) into directory
+    """
+    manifest = []
+    for name in df.columns:
+        values = df[name].to_numpy()
+        if name in INT_COLUMNS:
+            np.save(os.path.join(directory, f"{name}.npy"), values.astype(np.int64))
+            manifest.append(f"{name}\tint")
+        else:
+            codes, uniques = pd.factorize(values)
+            np.save(os.path.join(directory, f"{name}.codes.npy"), codes.astype(np.int32))
+            np.save(os.path.join(directory, f"{name}.values.npy"), np.asarray(uniques, dtype=str))
+            manifest.append(f"{name}\tstr")
+    with open(os.path.join(directory, MANIFEST), 'w') as ofile:
+        ofile.write('\n'.join(manifest) + '\n')
+
+def compile_reference(gtf_file, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Parse gtf_file once and write its column cache, unless a cache for this exact file already exists.
+    Returns the cache directory.
+    """
+    target = cache_path(gtf_file, cache_dir)
+    if os.path.exists(os.path.join(target, MANIFEST)):
+        logging.info(f"Using compiled reference {target}")
+        return target
+    logging.info(f"Compiling reference {gtf_file} into {target}")
+    os.makedirs(cache_dir, exist_ok=True)
+    df = parse_gtf(gtf_file)
+    # write into a scratch directory and rename, so concurrent jobs never see a partial cache
+    scratch = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        write_cache(df, scratch)
+        os.rename(scratch, target)
+    except OSError:
+        shutil.rmtree(scratch, ignore_errors=True)
+        if not os.path.exists(os.path.join(target, MANIFEST)):
+            raise
+    return target
+
+def load_gtf(gtf_file, cache_dir=DEFAULT_CACHE_DIR, usecols=None, features=None):
+    """
+    Load a GTF as a pandas DataFrame from its compiled cache, compiling it first if needed.
+
+    Args:
+        gtf_file (str): GTF file location
+        cache_dir (str): directory holding compiled references
+        usecols (list, optional): columns to load. Defaults to all columns.
+        features (iterable, optional): only keep rows whose feature is in this set
+
+    Returns:
+        pandas DataFrame: same layout as gtfparse.read_gtf
+    """
+    directory = compile_reference(gtf_file, cache_dir)
+    with open(os.path.join(directory, MANIFEST)) as file:
+        kinds = dict(line.rstrip('\n').split('\t') for line in file if line.strip())
+
+    def read_column(name, rows):
+        if kinds[name] == 'int':
+            values = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+            return np.asarray(values[rows])
+        codes = np.load(os.path.join(directory, f"{name}.codes.npy"), mmap_mode='r')
+        uniques = np.load(os.path.join(directory, f"{name}.values.npy")).astype(object)
+        return uniques[np.asarray(codes[rows])]
+
+    rows = slice(None)
+    if features is not None:
+        rows = np.flatnonzero(np.isin(read_column('feature', slice(None)), list(features)))
+    columns = list(kinds) if usecols is None else [col for col in kinds if col in set(usecols)]
+    return pd.DataFrame({name: read_column(name, rows) for name in columns})
+
+def main():
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Compile a GTF into a binary column cache')
+    parser.add_argument('--gtf', '-g', action='store', dest='gtf_file', help='Gencode GTF input file location', required=True)
+    parser.add_argument('--cache_dir', '-cd', action='store', dest='cache_dir', help='Compiled reference cache directory', default=DEFAULT_CACHE_DIR)
+    results = parser.parse_args()
+    print(compile_reference(results.gtf_file, results.cache_dir))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()